@@ -0,0 +1,25 @@
+from django.db import models
+from django.contrib.auth.models import User
+
+
+class Profile(models.Model):
+    """
+    Gives the benchmark users a facebook access token so send_now goes
+    through the facebook path (against StubGraphAPI).
+    """
+    user = models.ForeignKey(User, unique=True)
+    facebook_access_token = models.CharField(max_length=100, blank=True)
+
+
+class StubGraphAPI(object):
+    """
+    Stands in for notification.facebook.GraphAPI: wall posts are only
+    counted.
+    """
+    posts = 0
+
+    def __init__(self, access_token=None):
+        self.access_token = access_token
+
+    def put_wall_post(self, message, attachment={}, profile_id="me"):
+        StubGraphAPI.posts += 1
@@ -0,0 +1,229 @@
+"""
+Benchmarks for sending, queueing and reading notices.
+
+Creates a throwaway test database, fills it with synthetic users, notice
+types, settings and notices for each of the given sizes and prints the
+results as JSON so runs of different versions can be compared::
+
+    python -m benchmarks.run --sizes 10,100,1000 --output before.json
+
+Mail goes to Django's locmem backend and facebook posts to StubGraphAPI.
+With ``--delivery-latency SECONDS`` ``emit_notices`` is also measured
+against a local SMTP server that takes that long per message, sending one
+email at a time and with ``--delivery-threads`` concurrent deliveries.
+"""
+import os
+import sys
+import time
+import base64
+import platform
+from optparse import OptionParser
+
+try:
+    import json
+except ImportError:
+    import django.utils.simplejson as json
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "benchmarks.settings")
+
+NOTICE_TYPES = 10
+PASSWORD = "secret"
+
+
+def timed(func, repeat):
+    timings = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    return timings
+
+def result(name, size, timings, items=None):
+    ordered = sorted(timings)
+    mean = sum(timings) / len(timings)
+    row = {
+        "name": name,
+        "size": size,
+        "runs": len(timings),
+        "min": ordered[0],
+        "median": ordered[len(ordered) // 2],
+        "mean": mean,
+    }
+    if items:
+        row["items"] = items
+        row["per_second"] = items / max(mean, 0.000001)
+    return row
+
+
+def make_users(size, prefix):
+    from django.contrib.auth.models import User
+    from benchmarks.models import Profile
+    users = []
+    for i in range(size):
+        user = User.objects.create_user("%s%d" % (prefix, i), "%s%d@example.com" % (prefix, i), PASSWORD)
+        Profile.objects.create(user=user, facebook_access_token="token")
+        users.append(user)
+    return users
+
+def make_notice_types():
+    from notification import models as notification
+    labels = []
+    for i in range(NOTICE_TYPES):
+        label = "bench_%d" % i
+        notification.create_notice_type(label, "Benchmark %d" % i, "benchmark notice %d" % i, default=3)
+        labels.append(label)
+    return labels
+
+def make_notices(user, labels, size, context):
+    from notification import models as notification
+    for i in range(size):
+        label = labels[i % len(labels)]
+        if i % 2:
+            notification.send_now([user], label, {"i": i}, context=context)
+        else:
+            notification.send_now([user], label, {"i": i})
+
+
+def bench_send(size, labels, repeat):
+    from django.core import mail
+    from notification import models as notification
+    from notification import engine
+
+    users = make_users(size, "send%d_" % size)
+    rows = []
+
+    def send_now():
+        notification.send_now(users, labels[0], {"benchmark": True})
+        mail.outbox = []
+    rows.append(result("send_now", size, timed(send_now, repeat), size))
+
+    def queue():
+        notification.queue(users, labels[1], {"benchmark": True})
+    rows.append(result("queue", size, timed(queue, repeat), size))
+    notification.NoticeQueueBatch.objects.all().delete()
+
+    def send_all():
+        engine.send_all()
+        mail.outbox = []
+    timings = []
+    for i in range(repeat):
+        notification.queue(users, labels[2], {"benchmark": True})
+        timings.extend(timed(send_all, 1))
+    rows.append(result("engine.send_all", size, timings, size))
+    return rows
+
+def bench_delivery(size, labels, repeat, latency, threads):
+    from django.conf import settings
+    from notification import models as notification
+    from notification import engine
+    from notification.tests.stubs import StubSMTPServer
+
+    users = make_users(size, "delivery%d_" % size)
+    smtp = StubSMTPServer(delay=latency)
+    smtp.start()
+    old_email_settings = (settings.EMAIL_BACKEND, settings.EMAIL_HOST, settings.EMAIL_PORT)
+    settings.EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
+    settings.EMAIL_HOST, settings.EMAIL_PORT = "127.0.0.1", smtp.port
+    rows = []
+    try:
+        for name, delivery_threads in (("engine.send_all smtp", None),
+                                       ("engine.send_all smtp threads=%d" % threads, threads)):
+            timings = []
+            for i in range(repeat):
+                notification.queue(users, labels[3], {"benchmark": True})
+                timings.extend(timed(lambda: engine.send_all(delivery_threads=delivery_threads), 1))
+            rows.append(result(name, size, timings, size))
+    finally:
+        settings.EMAIL_BACKEND, settings.EMAIL_HOST, settings.EMAIL_PORT = old_email_settings
+        smtp.stop()
+    return rows
+
+def bench_views(size, labels, repeat):
+    from django.test.client import Client
+    from django.contrib.auth.models import Group
+    from django.core.urlresolvers import reverse
+
+    reader = make_users(1, "reader%d_" % size)[0]
+    group = Group.objects.create(name="bench%d" % size)
+    make_notices(reader, labels, size, group)
+
+    client = Client()
+    client.login(username=reader.username, password=PASSWORD)
+    feed_client = Client(HTTP_AUTHORIZATION="Basic %s" % base64.b64encode(
+        "%s:%s" % (reader.username, PASSWORD)))
+
+    urls = (
+        ("notices", client, reverse("notification_notices")),
+        ("notice_settings", client, reverse("notification_notice_settings")),
+        ("context_notices", client, reverse("notification_context_notices",
+                                            kwargs={"context": "group", "object_id": group.pk})),
+        ("json_feed", feed_client, reverse("notification_json_feed_for_user")),
+        ("context_json_feed", feed_client, reverse("notification_context_json_feed_for_user",
+                                                   kwargs={"context": "group", "object_id": group.pk})),
+        ("atom_feed", feed_client, reverse("notification_feed_for_user")),
+    )
+    rows = []
+    for name, view_client, url in urls:
+        def get():
+            response = view_client.get(url)
+            assert response.status_code == 200, "%s returned %s" % (url, response.status_code)
+        rows.append(result(name, size, timed(get, repeat)))
+    return rows
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--sizes", default="10,100,1000",
+                      help="comma separated numbers of recipients / notices per reader")
+    parser.add_option("--repeat", type="int", default=5,
+                      help="runs per measurement")
+    parser.add_option("--output", default=None,
+                      help="write the JSON results to this file instead of stdout")
+    parser.add_option("--delivery-latency", type="float", default=None,
+                      help="also measure emit_notices against a stub SMTP server answering after this many seconds")
+    parser.add_option("--delivery-threads", type="int", default=10,
+                      help="concurrent deliveries for the stub SMTP measurement")
+    options, args = parser.parse_args(argv)
+    sizes = [int(size) for size in options.sizes.split(",")]
+
+    from django.conf import settings
+    from django.db import connection
+    import notification
+    from notification import models as notification_models
+    from notification.metrics import metrics
+    from benchmarks.models import StubGraphAPI
+
+    notification_models.GraphAPI = StubGraphAPI
+
+    old_name = settings.DATABASES["default"]["NAME"]
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        labels = make_notice_types()
+        rows = []
+        for size in sizes:
+            rows.extend(bench_send(size, labels, options.repeat))
+            rows.extend(bench_views(size, labels, options.repeat))
+            if options.delivery_latency is not None:
+                rows.extend(bench_delivery(size, labels, options.repeat,
+                                           options.delivery_latency, options.delivery_threads))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    report = {
+        "version": notification.__version__,
+        "python": platform.python_version(),
+        "database": settings.DATABASES["default"]["ENGINE"],
+        "sizes": sizes,
+        "repeat": options.repeat,
+        "delivery_latency": options.delivery_latency,
+        "results": rows,
+        "metrics": metrics.snapshot(),
+    }
+    output = json.dumps(report, indent=2)
+    if options.output:
+        open(options.output, "w").write(output)
+    else:
+        print output
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,57 @@
+# Django settings used by the benchmarks, see benchmarks/run.py.
+#
+# The database defaults to a temporary SQLite file. Set the BENCH_DB_*
+# environment variables to run against another database, e.g.
+# BENCH_DB_ENGINE=django.db.backends.postgresql_psycopg2 BENCH_DB_NAME=bench
+import os
+import tempfile
+
+DEBUG = False
+TEMPLATE_DEBUG = False
+
+DATABASES = {
+    "default": {
+        "ENGINE": os.environ.get("BENCH_DB_ENGINE", "django.db.backends.sqlite3"),
+        "NAME": os.environ.get("BENCH_DB_NAME", "notification_bench"),
+        "USER": os.environ.get("BENCH_DB_USER", ""),
+        "PASSWORD": os.environ.get("BENCH_DB_PASSWORD", ""),
+        "HOST": os.environ.get("BENCH_DB_HOST", ""),
+        "PORT": os.environ.get("BENCH_DB_PORT", ""),
+    }
+}
+if DATABASES["default"]["ENGINE"].endswith("sqlite3"):
+    # a file instead of :memory: so the facebook threads see the same data
+    DATABASES["default"]["TEST_NAME"] = os.path.join(tempfile.gettempdir(), "notification_bench.db")
+
+SITE_ID = 1
+SECRET_KEY = "notification-benchmarks"
+ROOT_URLCONF = "benchmarks.urls"
+
+INSTALLED_APPS = (
+    "django.contrib.auth",
+    "django.contrib.contenttypes",
+    "django.contrib.sessions",
+    "django.contrib.sites",
+    "notification",
+    "benchmarks",
+)
+
+MIDDLEWARE_CLASSES = (
+    "django.middleware.common.CommonMiddleware",
+    "django.contrib.sessions.middleware.SessionMiddleware",
+    "django.contrib.auth.middleware.AuthenticationMiddleware",
+)
+
+TEMPLATE_CONTEXT_PROCESSORS = (
+    "django.core.context_processors.auth",
+    "notification.context_processors.notification",
+)
+
+# mail never leaves the process
+EMAIL_BACKEND = "django.core.mail.backends.locmem.EmailBackend"
+DEFAULT_FROM_EMAIL = "bench@example.com"
+
+AUTH_PROFILE_MODULE = "benchmarks.Profile"
+
+AUTO_NOTIFY = ()
+NOTIFICATION_CONTEXTS = {"group": "auth.group"}
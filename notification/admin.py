@@ -1,17 +1,24 @@
 from django.contrib import admin
-from notification.models import NoticeType, NoticeSetting, Notice, ObservedItem
+from notification.models import NoticeType, NoticeSetting, Notice, ArchivedNotice, ObservedItem, \
+    FailedNoticeBatch
 
 class NoticeTypeAdmin(admin.ModelAdmin):
-    list_display = ('label', 'display', 'description', 'default')
+    list_display = ('label', 'display', 'description', 'default', 'coalesce_window', 'priority')
 
 class NoticeSettingAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'notice_type', 'medium', 'send')
 
 class NoticeAdmin(admin.ModelAdmin):
-    list_display = ('message', 'user', 'notice_type', 'added', 'unseen', 'archived')
+    list_display = ('message', 'user', 'notice_type', 'added', 'unseen', 'archived', 'count')
+
+class FailedNoticeBatchAdmin(admin.ModelAdmin):
+    list_display = ('id', 'label', 'error_type', 'error', 'attempts', 'failed')
+    list_filter = ('label', 'error_type')
 
 
 admin.site.register(NoticeType, NoticeTypeAdmin)
 admin.site.register(NoticeSetting, NoticeSettingAdmin)
 admin.site.register(Notice, NoticeAdmin)
+admin.site.register(ArchivedNotice, NoticeAdmin)
 admin.site.register(ObservedItem)
+admin.site.register(FailedNoticeBatch, FailedNoticeBatchAdmin)
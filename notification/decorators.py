@@ -1,8 +1,17 @@
 from django.utils.translation import ugettext as _
 from django.http import HttpResponse
 from django.contrib.auth import authenticate, login
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.utils.hashcompat import sha_constructor, sha_hmac
+from django.utils.encoding import smart_str
 from django.conf import settings
 import threading
+import hmac
+
+# how long (in seconds) a verified basic auth header is trusted before the
+# password has to be checked again. Set to 0 to always call authenticate().
+AUTH_CACHE_TIMEOUT = getattr(settings, 'NOTIFICATION_AUTH_CACHE_TIMEOUT', 300)
 
 def simple_basic_auth_callback(request, user, *args, **kwargs):
     """
@@ -12,6 +21,55 @@ def simple_basic_auth_callback(request, user, *args, **kwargs):
     login(request, user)
     request.user = user
 
+def stateless_basic_auth_callback(request, user, *args, **kwargs):
+    """
+    Callback for feed readers and other clients that send their credentials
+    on every request: sets the user for the current request without creating
+    a session.
+    """
+    request.user = user
+
+def _auth_cache_key(header):
+    return 'notification_basic_auth_%s' % sha_constructor(settings.SECRET_KEY + header).hexdigest()
+
+def _password_digest(user):
+    # keeps the password hash itself out of the shared cache
+    return hmac.new(smart_str(settings.SECRET_KEY), smart_str(user.password), sha_hmac).hexdigest()
+
+def _authenticate_header(header):
+    """
+    Returns the user for a basic auth ``header`` or None.
+
+    Successful verifications are cached for ``NOTIFICATION_AUTH_CACHE_TIMEOUT``
+    seconds under a hash of the header, so clients polling with the same
+    credentials skip the password hash check. The cached entry stores an
+    HMAC of the password hash it was verified against, a password change
+    invalidates it.
+    """
+    cache_key = _auth_cache_key(header)
+    if AUTH_CACHE_TIMEOUT:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            user_id, digest, backend = cached
+            try:
+                user = User.objects.get(pk=user_id)
+            except User.DoesNotExist:
+                user = None
+            if user is not None and _password_digest(user) == digest:
+                user.backend = backend
+                return user
+            cache.delete(cache_key)
+
+    auth_method, auth = header.split(' ', 1)
+    if 'basic' != auth_method.lower():
+        return None
+    auth = auth.strip().decode('base64')
+    username, password = auth.split(':', 1)
+    user = authenticate(username=username, password=password)
+    if user is not None and AUTH_CACHE_TIMEOUT:
+        cache.set(cache_key, (user.pk, _password_digest(user), user.backend), AUTH_CACHE_TIMEOUT)
+    return user
+
 def basic_auth_required(realm=None, test_func=None, callback_func=None):
     """
     This decorator should be used with views that need simple authentication
@@ -23,7 +81,8 @@ def basic_auth_required(realm=None, test_func=None, callback_func=None):
     credentials and return the decorated function if successful.
     
     If unsuccessful the decorator will try to authenticate and checks if the
-    user has the ``is_active`` field set to True.
+    user has the ``is_active`` field set to True. Verified credentials are
+    cached for ``NOTIFICATION_AUTH_CACHE_TIMEOUT`` seconds.
     
     In case of a successful authentication  the ``callback_func`` will be
     called by passing the ``request`` and the ``user`` object. After that the
@@ -44,16 +103,12 @@ def basic_auth_required(realm=None, test_func=None, callback_func=None):
 
             # Not logged in, look if login credentials are provided
             if 'HTTP_AUTHORIZATION' in request.META:        
-                auth_method, auth = request.META['HTTP_AUTHORIZATION'].split(' ',1)
-                if 'basic' == auth_method.lower():
-                    auth = auth.strip().decode('base64')
-                    username, password = auth.split(':',1)
-                    user = authenticate(username=username, password=password)
-                    if user is not None:
-                        if user.is_active:
-                            if callback_func is not None and callable(callback_func):
-                                callback_func(request, user, *args, **kwargs)
-                            return view_func(request, *args, **kwargs)
+                user = _authenticate_header(request.META['HTTP_AUTHORIZATION'])
+                if user is not None:
+                    if user.is_active:
+                        if callback_func is not None and callable(callback_func):
+                            callback_func(request, user, *args, **kwargs)
+                        return view_func(request, *args, **kwargs)
 
             response =  HttpResponse(_('Authorization Required'), mimetype="text/plain")
             response.status_code = 401
@@ -0,0 +1,210 @@
+"""
+Concurrent delivery of emails and facebook posts.
+
+``send_now`` delivers each notice before moving on to the next recipient,
+so a batch spends most of its time waiting for SMTP and Graph API
+round-trips. While a ``DeliveryPool`` is active in the current thread,
+``send_now`` hands the deliveries to the pool instead and they run
+concurrently, at most ``max_in_flight`` at a time::
+
+    pool = DeliveryPool(max_in_flight=20)
+    activate(pool)
+    try:
+        notification.send_now(users, "friends_invite")
+    finally:
+        deactivate()
+        pool.wait()
+
+``emit_notices --delivery-threads N`` does this for every batch. A
+delivery that takes longer than the timeout of its medium (in seconds,
+``NOTIFICATION_DELIVERY_TIMEOUTS``) is given up on: its slot is freed and
+it is counted as timed out, although the thread can't be stopped and
+finishes on its own. Those threads still count toward
+``NOTIFICATION_DELIVERY_MAX_THREADS``, the most threads a pool runs at once.
+
+``send_now`` groups the deliveries of each recipient with ``finish()``;
+after ``wait()``, ``undelivered`` lists the recipients with a delivery that
+failed or timed out and ``failed_deliveries`` has those deliveries by
+recipient. ``emit_notices`` retries just those deliveries.
+"""
+import time
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection
+
+from notification.metrics import metrics, record_stage
+
+# how many deliveries may be in flight at once
+DELIVERY_THREADS = getattr(settings, "NOTIFICATION_DELIVERY_THREADS", 10)
+
+# seconds a delivery may take, by medium
+DELIVERY_TIMEOUTS = getattr(settings, "NOTIFICATION_DELIVERY_TIMEOUTS", {"1": 30, "2": 10})
+
+# how many threads a pool may run at once, counting the ones of deliveries
+# that timed out but haven't finished. None is twice the deliveries in flight.
+DELIVERY_MAX_THREADS = getattr(settings, "NOTIFICATION_DELIVERY_MAX_THREADS", None)
+
+_state = threading.local()
+
+
+class DeliveryPool(object):
+    """
+    Runs deliveries in threads, at most ``max_in_flight`` at a time and
+    ``max_threads`` threads in all, and keeps count of how they went per
+    medium.
+    """
+    def __init__(self, max_in_flight=DELIVERY_THREADS, timeouts=None, max_threads=DELIVERY_MAX_THREADS):
+        self.max_in_flight = max_in_flight
+        self.max_threads = max_threads or 2 * max_in_flight
+        self.timeouts = dict(DELIVERY_TIMEOUTS)
+        if timeouts:
+            self.timeouts.update(timeouts)
+        self.delivered = {}
+        self.failed = {}
+        self.timed_out = {}
+        self.errors = []
+        self.undelivered = []
+        self.failed_deliveries = {}
+        self._jobs = {}
+        self._next_job = 0
+        self._threads = 0
+        self._group = 0
+        self._groups = []
+        self._failed_groups = {}
+        self._condition = threading.Condition()
+
+    def submit(self, medium, label, func, *args, **kwargs):
+        """
+        Runs ``func(*args, **kwargs)`` in a new thread, waiting first if
+        ``max_in_flight`` deliveries or ``max_threads`` threads are running.
+        """
+        self._condition.acquire()
+        try:
+            timeout = self._expire()
+            while len(self._jobs) >= self.max_in_flight or self._threads >= self.max_threads:
+                self._condition.wait(timeout)
+                timeout = self._expire()
+            job = self._next_job
+            self._next_job += 1
+            deadline = None
+            if self.timeouts.get(medium):
+                deadline = time.time() + self.timeouts[medium]
+            self._jobs[job] = (medium, label, deadline, self._group, (func, args, kwargs))
+            self._threads += 1
+        finally:
+            self._condition.release()
+        thread = threading.Thread(target=self._run, args=(job, medium, label, func, args, kwargs))
+        thread.setDaemon(True)
+        thread.start()
+
+    def finish(self, key, callback=None):
+        """
+        Groups the deliveries submitted since the previous ``finish()`` under
+        ``key``. Once they are done, ``wait()`` calls ``callback()`` if they
+        all succeeded, and if not adds ``key`` to ``undelivered`` and the
+        ``(medium, label, func, args, kwargs)`` of the ones that failed or
+        timed out to ``failed_deliveries[key]``.
+        """
+        self._condition.acquire()
+        try:
+            self._groups.append((self._group, key, callback))
+            self._group += 1
+        finally:
+            self._condition.release()
+
+    def _run(self, job, medium, label, func, args, kwargs):
+        started = time.time()
+        error = None
+        try:
+            try:
+                func(*args, **kwargs)
+            except Exception, e:
+                error = e
+        finally:
+            # each thread gets its own database connection
+            connection.close()
+        self._condition.acquire()
+        try:
+            self._threads -= 1
+            if job in self._jobs:
+                group, call = self._jobs.pop(job)[3:]
+                if error is None:
+                    self.delivered[medium] = self.delivered.get(medium, 0) + 1
+                else:
+                    logging.error("delivering %s by medium %s failed: %r" % (label, medium, error))
+                    self.failed[medium] = self.failed.get(medium, 0) + 1
+                    self.errors.append((medium, label, repr(error)))
+                    self._failed_groups.setdefault(group, []).append((medium, label) + call)
+                    metrics.incr("delivery_failed", label, medium)
+            # else it was already given up on
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+        record_stage("deliver", started, label, medium)
+
+    def _expire(self):
+        """
+        Gives up on the deliveries past their deadline and returns how long
+        to wait for the next deadline, or None. Call with the lock held.
+        """
+        now = time.time()
+        next_deadline = None
+        for job, (medium, label, deadline, group, call) in self._jobs.items():
+            if deadline is None:
+                continue
+            if deadline <= now:
+                logging.error("delivering %s by medium %s timed out." % (label, medium))
+                del self._jobs[job]
+                self.timed_out[medium] = self.timed_out.get(medium, 0) + 1
+                self._failed_groups.setdefault(group, []).append((medium, label) + call)
+                metrics.incr("delivery_timed_out", label, medium)
+            elif next_deadline is None or deadline < next_deadline:
+                next_deadline = deadline
+        if next_deadline is None:
+            return None
+        return next_deadline - now
+
+    def wait(self):
+        """
+        Waits until every delivery is done or has timed out, settles the
+        groups of ``finish()`` and returns the counts per medium.
+        """
+        self._condition.acquire()
+        try:
+            timeout = self._expire()
+            while self._jobs:
+                self._condition.wait(timeout)
+                timeout = self._expire()
+            groups, self._groups = self._groups, []
+            failed_groups, self._failed_groups = self._failed_groups, {}
+        finally:
+            self._condition.release()
+        for group, key, callback in groups:
+            if group in failed_groups:
+                self.undelivered.append(key)
+                self.failed_deliveries.setdefault(key, []).extend(failed_groups[group])
+            elif callback is not None:
+                callback()
+        return self.stats()
+
+    def stats(self):
+        return {"delivered": dict(self.delivered), "failed": dict(self.failed),
+                "timed_out": dict(self.timed_out)}
+
+
+def activate(pool):
+    """
+    Makes ``send_now`` in the current thread deliver through ``pool``.
+    """
+    _state.pool = pool
+
+def deactivate():
+    _state.pool = None
+
+def get_pool():
+    """
+    Returns the pool active in the current thread, or None.
+    """
+    return getattr(_state, "pool", None)
@@ -1,6 +1,11 @@
 
+import os
 import sys
 import time
+import select
+import signal
+import socket
+import datetime
 import logging
 import traceback
 
@@ -10,65 +15,877 @@ except ImportError:
     import pickle
 
 from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q, Min, Max
 from django.core.mail import mail_admins
 from django.contrib.auth.models import User
-from django.contrib.sites.models import Site
+from django.template import Context
+from django.template.loader import render_to_string
+from django.utils.translation import get_language, activate
 
-from lockfile import FileLock, AlreadyLocked, LockTimeout
+from lockfile import AlreadyLocked, LockTimeout
 
-from notification.models import NoticeQueueBatch
+from notification.models import NoticeQueueBatch, FailedNoticeBatch, DigestItem, Notice, ArchivedNotice, \
+    IdempotencyKey, ActivityContext
 from notification import models as notification
+from notification import delivery
+from notification.locks import get_lock, process_exists
+from notification.metrics import metrics, record_stage
 
 # lock timeout value. how long to wait for the lock to become available.
 # default behavior is to never wait for the lock to be available.
 LOCK_WAIT_TIMEOUT = getattr(settings, "NOTIFICATION_LOCK_WAIT_TIMEOUT", -1)
 
-def send_all():
-    lock = FileLock("send_notices")
+# polling interval bounds (in seconds) of emit_notices --daemon
+POLL_MIN_INTERVAL = getattr(settings, "NOTIFICATION_POLL_MIN_INTERVAL", 1)
+POLL_MAX_INTERVAL = getattr(settings, "NOTIFICATION_POLL_MAX_INTERVAL", 60)
+
+# how many times a queued batch is tried before it is moved to
+# FailedNoticeBatch, and how long (in seconds, times the number of attempts)
+# to wait before trying it again
+MAX_ATTEMPTS = getattr(settings, "NOTIFICATION_MAX_ATTEMPTS", 3)
+RETRY_DELAY = getattr(settings, "NOTIFICATION_RETRY_DELAY", 60)
+
+# how long (in seconds) a batch may take in an emit_notices --processes
+# worker before it is given up on and its worker killed. None waits forever.
+BATCH_TIMEOUT = getattr(settings, "NOTIFICATION_BATCH_TIMEOUT", 3600)
+
+# how many users' digests are loaded and rendered together
+DIGEST_BATCH_SIZE = getattr(settings, "NOTIFICATION_DIGEST_BATCH_SIZE", 100)
+
+# retention policies for prune_notices, by notice type label. "*" applies to
+# the labels that aren't listed. Each policy may have "max_age" (in days),
+# "keep_last" (notices per user) and "archived_only".
+RETENTION = getattr(settings, "NOTIFICATION_RETENTION", {})
+
+# notices older than this many days are moved to ArchivedNotice by
+# archive_notices even if they weren't archived. None disables it.
+ARCHIVE_AFTER = getattr(settings, "NOTIFICATION_ARCHIVE_AFTER", None)
+
+def send_all(limit=None, max_seconds=None, stop=None, lanes=None, processes=None,
+             delivery_threads=None):
+    """
+    Sends the queued notices, in priority order and then oldest first. If
+    ``lanes`` is given only batches with those priorities are sent. Batches
+    scheduled for later are left in the queue.
+
+    With ``processes`` greater than one, batches are rendered and delivered
+    by a pool of that many worker processes, each with its own database
+    connection; this process claims the batches and deletes them once sent.
+    With ``delivery_threads`` the emails and facebook posts of each batch
+    are sent concurrently by a ``notification.delivery.DeliveryPool`` of
+    that size, and the batch is deleted once they are done. The deliveries
+    that failed or timed out are retried like a failed batch, without
+    storing their notices again.
+
+    A batch that fails is retried later with the notices that weren't sent,
+    up to ``NOTIFICATION_MAX_ATTEMPTS`` times, and then moved to
+    ``FailedNoticeBatch``; the run goes on with the other batches and the
+    admins get one email listing the failures.
+
+    Stops after ``limit`` batches, once a batch ends more than
+    ``max_seconds`` after the start or when the ``stop`` callable returns
+    True, if given. Returns a summary of the run:
+    the totals, the timing of each batch, the count and time spent per
+    notice type label, the failed batches and when the next scheduled batch
+    is due.
+    """
+    summary = {"batches": 0, "sent": 0, "skipped": 0, "seconds": 0.0, "error": None, "failures": [],
+               "batch_timings": [], "labels": {}, "next_due": None,
+               "delivery": {"delivered": {}, "failed": {}, "timed_out": {}}}
+    lock = get_lock("send_notices")
 
     logging.debug("acquiring lock...")
     try:
         lock.acquire(LOCK_WAIT_TIMEOUT)
     except AlreadyLocked:
         logging.debug("lock already in place. quitting.")
-        return
+        return summary
     except LockTimeout:
         logging.debug("waiting for the lock timed out. quitting.")
-        return
+        return summary
     logging.debug("acquired.")
 
-    batches, sent = 0, 0
     start_time = time.time()
 
+    def more_batches(in_flight=0):
+        if lock.lost:
+            logging.error("lost the lock, stopping.")
+            return False
+        if limit is not None and summary["batches"] + in_flight >= limit:
+            logging.info("batch limit reached.")
+            return False
+        if max_seconds is not None and time.time() - start_time >= max_seconds:
+            logging.info("time budget exhausted.")
+            return False
+        return stop is None or not stop()
+
     try:
         # nesting the try statement to be Python 2.4
         try:
-            for queued_batch in NoticeQueueBatch.objects.all():
-                notices = pickle.loads(str(queued_batch.pickled_data).decode("base64"))
-                for user, label, extra_context, on_site in notices:
-                    user = User.objects.get(pk=user)
-                    logging.info("emitting notice to %s" % user)
-                    # call this once per user to be atomic and allow for logging to
-                    # accurately show how long each takes.
-                    notification.send_now([user], label, extra_context, on_site)
-                    sent += 1
-                queued_batch.delete()
-                batches += 1
+            queued_batches = NoticeQueueBatch.objects.order_by("priority", "id")
+            if lanes:
+                queued_batches = queued_batches.filter(priority__in=lanes)
+            due_batches = queued_batches.filter(
+                Q(send_at__isnull=True) | Q(send_at__lte=datetime.datetime.now()))
+            if processes and processes > 1:
+                _send_batches_in_pool(processes, queued_batches, due_batches, more_batches, summary,
+                                      delivery_threads)
+            else:
+                while more_batches():
+                    # fetched one at a time so urgent batches queued during
+                    # the run go before the remaining ones
+                    try:
+                        queued_batch = due_batches[0]
+                    except IndexError:
+                        summary["next_due"] = _next_due(queued_batches)
+                        break
+                    batch_started = time.time()
+                    result = _send_batch(queued_batch.pickled_data, delivery_threads,
+                                         queued_batch.idempotency_key)
+                    _finish_batch(summary, queued_batch, result, batch_started)
         except:
             # get the exception
             exc_class, e, t = sys.exc_info()
             # email people
-            current_site = Site.objects.get_current()
+            current_site = notification.get_send_environment().site
             subject = "[%s emit_notices] %r" % (current_site.name, e)
             message = "%s" % ("\n".join(traceback.format_exception(*sys.exc_info())),)
             mail_admins(subject, message, fail_silently=True)
             # log it as critical
             logging.critical("an exception occurred: %r" % e)
+            summary["error"] = repr(e)
     finally:
         logging.debug("releasing lock...")
         lock.release()
         logging.debug("released.")
     
+    if summary["failures"]:
+        _mail_failures(summary["failures"])
+    record_stage("send_all", start_time)
+    summary["seconds"] = time.time() - start_time
     logging.info("")
-    logging.info("%s batches, %s sent" % (batches, sent,))
+    logging.info("%s batches, %s sent, %s already sent, %s failed" % (
+        summary["batches"], summary["sent"], summary["skipped"], len(summary["failures"])))
+    logging.info("done in %.2f seconds" % summary["seconds"])
+    return summary
+
+def _next_due(queued_batches):
+    return queued_batches.aggregate(next_due=Min("send_at"))["next_due"]
+
+def _send_batch(pickled_data, delivery_threads=None, idempotency_key=None):
+    """
+    Sends the notices of a queued batch and returns how many were sent, the
+    count and time spent per label and, with ``delivery_threads``, the
+    delivery counts per medium. With an ``idempotency_key`` the users that
+    already got the notice are looked up once for the whole batch and
+    skipped.
+
+    Each user's notice is sent in a transaction of its own, so the notice
+    of a user whose send raised isn't stored. If sending fails, ``failure``
+    describes the error and holds the notices that weren't sent (None if
+    the batch couldn't be read).
+
+    Besides the ``(user_id, label, extra_context, on_site, context)`` of
+    notices, a retried batch can hold ``(user_id, label, deliveries)``
+    entries: the ``(medium, func, args, kwargs)`` of the deliveries of a
+    stored notice that failed or timed out, which are all that is sent
+    again.
+    """
+    result = {"sent": 0, "skipped": 0, "labels": {}, "delivery": None, "failure": None}
+    notices = None
+    pool = None
+    try:
+        try:
+            notices = pickle.loads(str(pickled_data).decode("base64"))
+            users = User.objects.in_bulk([notice[0] for notice in notices])
+            sent_notices = None
+            if idempotency_key:
+                sent_notices = notification.SentNotices(users.values(), idempotency_key)
+            if delivery_threads:
+                pool = delivery.DeliveryPool(delivery_threads)
+                delivery.activate(pool)
+            send_now = transaction.commit_on_success(notification.send_now)
+            for notice in notices:
+                user, label = users[notice[0]], notice[1]
+                if sent_notices is not None and sent_notices.already_sent(user):
+                    logging.info("already sent to %s" % user)
+                    result["sent"] += 1
+                    result["skipped"] += 1
+                    continue
+                notice_started = time.time()
+                if len(notice) == 3:
+                    logging.info("redelivering notice to %s" % user)
+                    _redeliver(user, label, notice[2], pool, sent_notices)
+                else:
+                    logging.info("emitting notice to %s" % user)
+                    # call this once per user to be atomic and allow for logging to
+                    # accurately show how long each takes.
+                    send_now([user], label, notice[2], notice[3], notice[4],
+                             idempotency_key=sent_notices)
+                label_stats = result["labels"].setdefault(label, {"sent": 0, "seconds": 0.0})
+                label_stats["sent"] += 1
+                label_stats["seconds"] += time.time() - notice_started
+                result["sent"] += 1
+        except Exception:
+            # interrupts are left to send_all, which stops the run
+            exc_class, e, t = sys.exc_info()
+            # a failed query leaves the transaction unusable on some databases
+            transaction.rollback_unless_managed()
+            remaining, label = None, ""
+            if notices is not None:
+                remaining = notices[result["sent"]:]
+                if notices:
+                    label = notices[0][1]
+            result["failure"] = {
+                "label": label,
+                "error_type": exc_class.__name__,
+                "error": repr(e),
+                "traceback": "".join(traceback.format_exception(exc_class, e, t)),
+                "remaining": remaining,
+            }
+    finally:
+        if pool is not None:
+            delivery.deactivate()
+            result["delivery"] = pool.wait()
+            if pool.undelivered:
+                _add_undelivered(result, notices, pool)
+    return result
+
+def _redeliver(user, label, deliveries, pool, sent_notices):
+    """
+    Sends the ``deliveries`` of a notice to ``user`` again. Without a pool
+    they are sent one after another and taken off the list once sent, so
+    a retry doesn't repeat them.
+    """
+    mark_sent = None
+    if sent_notices is not None:
+        mark_sent = lambda: sent_notices.mark_sent(user)
+    if pool is not None:
+        for medium, func, args, kwargs in deliveries:
+            pool.submit(medium, label, func, *args, **kwargs)
+        pool.finish(user, mark_sent)
+    else:
+        while deliveries:
+            medium, func, args, kwargs = deliveries[0]
+            func(*args, **kwargs)
+            del deliveries[0]
+        if mark_sent is not None:
+            mark_sent()
+
+def _add_undelivered(result, notices, pool):
+    """
+    Makes the deliveries that failed or timed out in ``pool`` part of the
+    batch's failure, so they are retried without storing their notices
+    again.
+    """
+    redeliveries = []
+    for user in pool.undelivered:
+        # a user the batch had twice is listed twice with the deliveries of both
+        if user.pk in [notice[0] for notice in redeliveries]:
+            continue
+        deliveries = pool.failed_deliveries[user]
+        redeliveries.append((user.pk, deliveries[0][1], [(medium, func, args, kwargs)
+                             for medium, label, func, args, kwargs in deliveries]))
+    failed = sum(pool.failed.values())
+    timed_out = sum(pool.timed_out.values())
+    error = "%d deliveries failed and %d timed out" % (failed, timed_out)
+    if pool.errors:
+        error += ", the first with %s" % pool.errors[0][2]
+    if result["failure"] is None:
+        result["failure"] = {
+            "label": notices[0][1],
+            "error_type": "DeliveryFailed",
+            "error": error,
+            "traceback": "",
+            "remaining": redeliveries,
+        }
+    else:
+        result["failure"]["error"] += "; %s" % error
+        if result["failure"]["remaining"] is not None:
+            result["failure"]["remaining"] = redeliveries + result["failure"]["remaining"]
+
+def _finish_batch(summary, queued_batch, result, batch_started):
+    """
+    Deletes a sent batch, or retries or moves a failed one, and adds its
+    result to the summary.
+    """
+    if result["failure"] is None:
+        batch_id = queued_batch.pk
+        queued_batch.delete()
+        _add_batch_result(summary, batch_id, result, batch_started)
+    else:
+        _fail_batch(summary, queued_batch, result["failure"])
+
+def _fail_batch(summary, queued_batch, failure):
+    logging.error("batch %s failed: %s" % (queued_batch.pk, failure["error"]))
+    metrics.incr("failed_batches", failure["label"] or None)
+    if failure["remaining"] is not None:
+        queued_batch.pickled_data = pickle.dumps(failure["remaining"]).encode("base64")
+    queued_batch.attempts += 1
+    failed = {"id": queued_batch.pk, "label": failure["label"], "error": failure["error"],
+              "attempts": queued_batch.attempts, "dead_letter": False}
+    summary["failures"].append(failed)
+    if failure["remaining"] == []:
+        queued_batch.delete()
+    elif queued_batch.attempts < MAX_ATTEMPTS:
+        queued_batch.send_at = datetime.datetime.now() + datetime.timedelta(
+            seconds=RETRY_DELAY * queued_batch.attempts)
+        queued_batch.save()
+    else:
+        FailedNoticeBatch.objects.create(pickled_data=queued_batch.pickled_data,
+            label=failure["label"], priority=queued_batch.priority, batch_id=queued_batch.pk,
+            attempts=queued_batch.attempts, error_type=failure["error_type"],
+            error=failure["error"], traceback=failure["traceback"],
+            idempotency_key=queued_batch.idempotency_key)
+        failed["dead_letter"] = True
+        failed["traceback"] = failure["traceback"]
+        queued_batch.delete()
+
+def _mail_failures(failures):
+    current_site = notification.get_send_environment().site
+    subject = "[%s emit_notices] %d batches failed" % (current_site.name, len(failures))
+    lines = []
+    for failed in failures:
+        if failed["dead_letter"]:
+            outcome = "moved to the failed notice batches"
+        else:
+            outcome = "will be retried"
+        lines.append("batch %(id)s (%(label)s), attempt %(attempts)s: %(error)s" % failed)
+        lines.append("  %s" % outcome)
+        if failed.get("traceback"):
+            lines.append(failed["traceback"])
+    mail_admins(subject, "\n".join(lines), fail_silently=True)
+
+def _add_batch_result(summary, batch_id, result, batch_started):
+    summary["batches"] += 1
+    summary["sent"] += result["sent"] - result["skipped"]
+    summary["skipped"] += result["skipped"]
+    for label, stats in result["labels"].items():
+        label_stats = summary["labels"].setdefault(label, {"sent": 0, "seconds": 0.0})
+        label_stats["sent"] += stats["sent"]
+        label_stats["seconds"] += stats["seconds"]
+    if result["delivery"]:
+        for outcome, counts in result["delivery"].items():
+            for medium, count in counts.items():
+                totals = summary["delivery"][outcome]
+                totals[medium] = totals.get(medium, 0) + count
+    summary["batch_timings"].append({"id": batch_id, "notices": result["sent"],
+                                     "seconds": time.time() - batch_started})
+    record_stage("batch", batch_started)
+    metrics.incr("batches")
+
+_started = None
+
+def _init_worker(started):
+    global _started
+    _started = started
+    # the forked connection belongs to the parent; open a new one
+    connection.connection = None
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+def _send_batch_in_worker(task, batch_id, pickled_data, delivery_threads, idempotency_key):
+    """
+    Runs ``_send_batch`` in a pool worker, after telling the main process
+    which worker has the task.
+    """
+    _started.put((task, os.getpid()))
+    try:
+        return batch_id, _send_batch(pickled_data, delivery_threads, idempotency_key)
+    finally:
+        connection.close()
+
+def _batch_idempotency_key(queued_batch):
+    """
+    Returns the idempotency key of a batch, first giving it one of its own
+    if it was queued without one. Then if its worker dies or is killed, the
+    users it was already sent to are skipped when it is retried.
+    """
+    if not queued_batch.idempotency_key:
+        queued_batch.idempotency_key = "batch:%s" % os.urandom(8).encode("hex")
+        NoticeQueueBatch.objects.filter(pk=queued_batch.pk).update(
+            idempotency_key=queued_batch.idempotency_key)
+    return queued_batch.idempotency_key
+
+def _lost_batch_failure(queued_batch, error_type, error):
+    """
+    The failure of a batch whose worker died or ran out of time. How far
+    it got is unknown, so all of its notices are kept; its idempotency key
+    skips the users that were sent to.
+    """
+    try:
+        label = pickle.loads(str(queued_batch.pickled_data).decode("base64"))[0][1]
+    except Exception:
+        label = ""
+    return {"label": label, "error_type": error_type, "error": error, "traceback": "",
+            "remaining": None}
+
+def _send_batches_in_pool(processes, queued_batches, due_batches, more_batches, summary,
+                          delivery_threads=None, batch_timeout=BATCH_TIMEOUT):
+    """
+    Keeps up to ``processes`` batches in flight in a process pool, claiming
+    the next due one whenever a worker finishes.
+
+    A batch whose worker dies, or that is still running ``batch_timeout``
+    seconds after it was handed to the pool (its worker is then killed),
+    fails like a batch that raised an error and is retried later. Batches
+    are sent with an idempotency key, one of their own if they were queued
+    without one, so the retry skips the users that were already sent to.
+    """
+    import Queue
+    import multiprocessing
+    from multiprocessing.queues import SimpleQueue
+
+    # the workers must not share this process' database connection
+    connection.close()
+    # written without a feeder thread, so a worker that dies right after
+    # taking a task has still said so
+    started = SimpleQueue()
+    pool = multiprocessing.Pool(processes, _init_worker, (started,))
+    done = Queue.Queue()
+    in_flight = {}
+    tasks = {}
+    next_task = 0
+    given_up = False
+    try:
+        while True:
+            while len(in_flight) < processes and more_batches(len(in_flight)):
+                next_batches = due_batches
+                if in_flight:
+                    next_batches = next_batches.exclude(pk__in=in_flight.keys())
+                try:
+                    queued_batch = next_batches[0]
+                except IndexError:
+                    if not in_flight:
+                        summary["next_due"] = _next_due(queued_batches)
+                    break
+                task = next_task
+                next_task += 1
+                async_result = pool.apply_async(_send_batch_in_worker,
+                    (task, queued_batch.pk, queued_batch.pickled_data, delivery_threads,
+                     _batch_idempotency_key(queued_batch)),
+                    callback=done.put)
+                in_flight[queued_batch.pk] = {"batch": queued_batch, "started": time.time(),
+                                              "result": async_result, "task": task, "pid": None}
+                tasks[task] = queued_batch.pk
+            if not in_flight:
+                break
+            # woken up as soon as a batch is done; the timeout keeps the
+            # wait interruptible by signals and notices dead workers
+            try:
+                done.get(True, 1)
+            except Queue.Empty:
+                pass
+            while not started.empty():
+                task, pid = started.get()
+                batch_id = tasks.pop(task, None)
+                if batch_id in in_flight:
+                    in_flight[batch_id]["pid"] = pid
+            now = time.time()
+            for batch_id, batch in in_flight.items():
+                failure = None
+                if batch["result"].ready():
+                    try:
+                        result = batch["result"].get()[1]
+                    except Exception, e:
+                        failure = _lost_batch_failure(batch["batch"], e.__class__.__name__, repr(e))
+                    else:
+                        del in_flight[batch_id]
+                        _finish_batch(summary, batch["batch"], result, batch["started"])
+                        continue
+                elif batch["pid"] is not None and not process_exists(batch["pid"]):
+                    failure = _lost_batch_failure(batch["batch"], "WorkerLost",
+                        "worker %s died while sending the batch" % batch["pid"])
+                    given_up = True
+                elif batch_timeout is not None and now - batch["started"] > batch_timeout:
+                    failure = _lost_batch_failure(batch["batch"], "BatchTimeout",
+                        "the batch took more than %s seconds" % batch_timeout)
+                    given_up = True
+                    if batch["pid"] is not None:
+                        # it must not keep sending while the batch is retried
+                        try:
+                            os.kill(batch["pid"], signal.SIGTERM)
+                        except OSError:
+                            pass
+                else:
+                    continue
+                del in_flight[batch_id]
+                tasks.pop(batch["task"], None)
+                _fail_batch(summary, batch["batch"], failure)
+    finally:
+        if given_up:
+            # the pool waits forever for the results of lost tasks
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
+
+def send_forever(min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL,
+                 wakeup_socket=notification.WAKEUP_SOCKET, **kwargs):
+    """
+    Keeps calling ``send_all`` until SIGTERM or SIGINT is received, which
+    stops it once the current batch is sent.
+
+    While the queue is empty it polls with an interval that doubles from
+    ``min_interval`` up to ``max_interval`` seconds, but wakes up in time for
+    the next scheduled batch. If ``wakeup_socket`` is set, a Unix datagram
+    socket is bound to that path and ``queue()`` uses it to wake the loop up
+    as soon as a batch is queued.
+    """
+    stopping = []
+    def stop(signum, frame):
+        logging.info("got signal %s, stopping after the current batch." % signum)
+        stopping.append(signum)
+    # restart the system calls of the batch being sent instead of failing
+    # them with EINTR; the idle wait uses select(), which still wakes up
+    signal.signal(signal.SIGTERM, stop)
+    signal.siginterrupt(signal.SIGTERM, False)
+    signal.signal(signal.SIGINT, stop)
+    signal.siginterrupt(signal.SIGINT, False)
+
+    sock = None
+    if wakeup_socket:
+        if os.path.exists(wakeup_socket):
+            os.unlink(wakeup_socket)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(wakeup_socket)
+
+    interval = min_interval
+    try:
+        while not stopping:
+            summary = send_all(stop=lambda: bool(stopping), **kwargs)
+            # don't keep a connection (and its transaction) open while idle
+            connection.close()
+            if summary["batches"] and not summary["error"]:
+                interval = min_interval
+                continue
+            if stopping:
+                break
+            timeout = interval
+            if summary["next_due"] is not None:
+                due_in = summary["next_due"] - datetime.datetime.now()
+                timeout = max(min(timeout, due_in.days * 86400 + due_in.seconds + 1), 0)
+            if _wait_for_wakeup(sock, timeout):
+                interval = min_interval
+            else:
+                interval = min(interval * 2, max_interval)
+    finally:
+        if sock is not None:
+            sock.close()
+            os.unlink(wakeup_socket)
+    logging.info("stopped.")
+
+def _wait_for_wakeup(sock, timeout):
+    """
+    Sleeps up to ``timeout`` seconds. Returns True if woken up through
+    ``sock``.
+    """
+    if sock is None:
+        time.sleep(timeout)
+        return False
+    try:
+        readable = select.select([sock], [], [], timeout)[0]
+    except select.error:
+        # interrupted by a signal
+        return False
+    if not readable:
+        return False
+    # drain the wake ups sent while we were busy
+    sock.setblocking(0)
+    try:
+        try:
+            while True:
+                sock.recv(64)
+        except socket.error:
+            pass
+    finally:
+        sock.setblocking(1)
+    return True
+
+def replay_failed_notices(labels=None, error_types=None, chunk_size=1000, dry_run=False):
+    """
+    Queues the notices of the failed batches again, optionally only those
+    of the given notice type ``labels`` or ``error_types`` (exception class
+    names), ``chunk_size`` batches per transaction. Returns how many
+    batches there were.
+    """
+    failed_batches = FailedNoticeBatch.objects.all()
+    if labels:
+        failed_batches = failed_batches.filter(label__in=labels)
+    if error_types:
+        failed_batches = failed_batches.filter(error_type__in=error_types)
+    if dry_run:
+        count = failed_batches.count()
+        logging.info("%s failed batches would be queued again." % count)
+        return count
+    start_time = time.time()
+    ids = list(failed_batches.values_list("id", flat=True))
+    for i in range(0, len(ids), chunk_size):
+        _requeue(ids[i:i + chunk_size])
+    if ids:
+        notification.wake_up_emitter()
+    logging.info("%s failed batches queued again in %.2f seconds" % (len(ids), time.time() - start_time))
+    return len(ids)
+
+def _requeue(ids):
+    for failed_batch in FailedNoticeBatch.objects.filter(pk__in=ids):
+        NoticeQueueBatch(pickled_data=failed_batch.pickled_data, priority=failed_batch.priority,
+                         idempotency_key=failed_batch.idempotency_key).save()
+    FailedNoticeBatch.objects.filter(pk__in=ids).delete()
+_requeue = transaction.commit_on_success(_requeue)
+
+def send_digests(batch_size=DIGEST_BATCH_SIZE):
+    """
+    Sends one email per user with all the notices collected for the "Email
+    digest" medium since the last run. Pending items of ``batch_size`` users
+    are fetched with a single query and deleted once their digests are sent.
+    """
+    lock = get_lock("send_digests")
+
+    logging.debug("acquiring lock...")
+    try:
+        lock.acquire(LOCK_WAIT_TIMEOUT)
+    except AlreadyLocked:
+        logging.debug("lock already in place. quitting.")
+        return
+    except LockTimeout:
+        logging.debug("waiting for the lock timed out. quitting.")
+        return
+    logging.debug("acquired.")
+
+    digests, items = 0, 0
+    start_time = time.time()
+
+    environment = notification.get_send_environment()
+    current_site = environment.site
+    notices_url = environment.notices_url
+    current_language = get_language()
+
+    try:
+        user_ids = list(DigestItem.objects.order_by("user").values_list("user", flat=True).distinct())
+        for start in range(0, len(user_ids), batch_size):
+            pending = DigestItem.objects.filter(user__in=user_ids[start:start + batch_size]).select_related(
+                "user", "notice", "notice__notice_type").order_by("user", "added")
+            by_user = {}
+            for item in pending:
+                by_user.setdefault(item.user_id, []).append(item)
+            for user_items in by_user.values():
+                user = user_items[0].user
+                if user.email:
+                    send_digest(user, [item.notice for item in user_items], current_site, notices_url)
+                    digests += 1
+                DigestItem.objects.filter(pk__in=[item.pk for item in user_items]).delete()
+                items += len(user_items)
+    finally:
+        activate(current_language)
+        logging.debug("releasing lock...")
+        lock.release()
+        logging.debug("released.")
+
+    logging.info("")
+    logging.info("%s digests, %s notices" % (digests, items,))
     logging.info("done in %.2f seconds" % (time.time() - start_time))
+
+def send_digest(user, notices, current_site, notices_url):
+    try:
+        language = notification.get_notification_language(user)
+    except notification.LanguageStoreNotAvailable:
+        language = None
+    if language is not None:
+        activate(language)
+
+    template_context = Context({
+        "user": user,
+        "notices": notices,
+        "notices_url": notices_url,
+        "current_site": current_site,
+    }, autoescape=False)
+    # Strip newlines from subject
+    subject = ''.join(render_to_string('notification/digest_subject.txt',
+                                       context_instance=template_context).splitlines())
+    body = render_to_string('notification/digest_body.txt', context_instance=template_context)
+    notification.send_mail(subject, body, settings.DEFAULT_FROM_EMAIL, [user.email])
+
+def prune_notices(policies=None, chunk_size=1000, pause=0, dry_run=False):
+    """
+    Deletes the notices that the retention ``policies`` (by default the
+    NOTIFICATION_RETENTION setting) don't keep.
+
+    Rows are deleted in primary key ranges of ``chunk_size``, sleeping
+    ``pause`` seconds after each chunk, so no statement holds locks for
+    long. Returns the number of deleted (or, with ``dry_run``, deletable)
+    notices. Expired idempotency keys are deleted as well.
+    """
+    if policies is None:
+        policies = RETENTION
+    lock = get_lock("prune_notices")
+
+    logging.debug("acquiring lock...")
+    try:
+        lock.acquire(LOCK_WAIT_TIMEOUT)
+    except AlreadyLocked:
+        logging.debug("lock already in place. quitting.")
+        return 0
+    except LockTimeout:
+        logging.debug("waiting for the lock timed out. quitting.")
+        return 0
+    logging.debug("acquired.")
+
+    total = 0
+    start_time = time.time()
+    try:
+        for notice_type in notification.notice_types.all():
+            policy = policies.get(notice_type.label, policies.get("*"))
+            if not policy:
+                continue
+            type_start = time.time()
+            deleted = 0
+            for model in (Notice, ArchivedNotice):
+                qs = model.objects.filter(notice_type=notice_type)
+                if policy.get("archived_only"):
+                    qs = qs.filter(archived=True)
+                if policy.get("max_age"):
+                    since = datetime.datetime.now() - datetime.timedelta(days=policy["max_age"])
+                    deleted += _prune_range(qs.filter(added__lt=since), chunk_size, pause, dry_run)
+                if policy.get("keep_last"):
+                    # only counts the notices that are in the same table
+                    deleted += _prune_keep_last(qs, policy["keep_last"], chunk_size, pause, dry_run)
+            elapsed = time.time() - type_start
+            logging.info("%s: %s notices in %.2f seconds (%.1f rows/sec)" % (
+                notice_type.label, deleted, elapsed, deleted / max(elapsed, 0.001)))
+            total += deleted
+        since = datetime.datetime.now() - datetime.timedelta(seconds=notification.IDEMPOTENCY_WINDOW)
+        expired = _prune_range(IdempotencyKey.objects.filter(added__lt=since), chunk_size, pause, dry_run)
+        logging.info("%s expired idempotency keys" % expired)
+    finally:
+        logging.debug("releasing lock...")
+        lock.release()
+        logging.debug("released.")
+
+    elapsed = time.time() - start_time
+    logging.info("")
+    logging.info("%s notices %s" % (total, dry_run and "to prune" or "pruned"))
+    logging.info("done in %.2f seconds (%.1f rows/sec)" % (elapsed, total / max(elapsed, 0.001)))
+    return total
+
+def _delete_ids(model, ids, chunk_size, pause, dry_run):
+    for start in range(0, len(ids), chunk_size):
+        if not dry_run:
+            model.objects.filter(pk__in=ids[start:start + chunk_size]).delete()
+            if pause:
+                time.sleep(pause)
+    return len(ids)
+
+def _prune_range(qs, chunk_size, pause, dry_run):
+    bounds = qs.aggregate(low=Min("pk"), high=Max("pk"))
+    if bounds["low"] is None:
+        return 0
+    deleted = 0
+    low = bounds["low"]
+    while low <= bounds["high"]:
+        ids = list(qs.filter(pk__gte=low, pk__lt=low + chunk_size).values_list("pk", flat=True))
+        deleted += _delete_ids(qs.model, ids, chunk_size, pause, dry_run)
+        low += chunk_size
+    return deleted
+
+def _prune_keep_last(qs, keep_last, chunk_size, pause, dry_run):
+    deleted = 0
+    for user_id in qs.order_by().values_list("user", flat=True).distinct():
+        ids = list(qs.filter(user=user_id).order_by("-added", "-pk").values_list("pk", flat=True)[keep_last:])
+        ids.sort()
+        deleted += _delete_ids(qs.model, ids, chunk_size, pause, dry_run)
+    return deleted
+
+def archive_notices(max_age=ARCHIVE_AFTER, chunk_size=1000, pause=0):
+    """
+    Moves the archived notices, and those older than ``max_age`` days, from
+    the Notice table to ArchivedNotice, which keeps their ids as
+    ``original_id``.
+
+    The table is walked in primary key ranges of ``chunk_size``. Each range
+    is copied and deleted in its own transaction, sleeping ``pause`` seconds
+    in between. Notices still waiting for an email digest are left alone.
+    Returns the number of moved notices.
+    """
+    lock = get_lock("archive_notices")
+
+    logging.debug("acquiring lock...")
+    try:
+        lock.acquire(LOCK_WAIT_TIMEOUT)
+    except AlreadyLocked:
+        logging.debug("lock already in place. quitting.")
+        return 0
+    except LockTimeout:
+        logging.debug("waiting for the lock timed out. quitting.")
+        return 0
+    logging.debug("acquired.")
+
+    moved = 0
+    start_time = time.time()
+    try:
+        qs = Notice.objects.filter(digestitem__isnull=True)
+        if max_age:
+            since = datetime.datetime.now() - datetime.timedelta(days=max_age)
+            qs = qs.filter(Q(archived=True) | Q(added__lt=since))
+        else:
+            qs = qs.filter(archived=True)
+        bounds = qs.aggregate(low=Min("pk"), high=Max("pk"))
+        low = bounds["low"]
+        while low is not None and low <= bounds["high"]:
+            moved += _archive_range(qs.filter(pk__gte=low, pk__lt=low + chunk_size))
+            low += chunk_size
+            if pause:
+                time.sleep(pause)
+    finally:
+        logging.debug("releasing lock...")
+        lock.release()
+        logging.debug("released.")
+
+    elapsed = time.time() - start_time
+    logging.info("")
+    logging.info("%s notices archived" % moved)
+    logging.info("done in %.2f seconds (%.1f rows/sec)" % (elapsed, moved / max(elapsed, 0.001)))
+    return moved
+
+def _archive_range(qs):
+    notices = list(qs)
+    if not notices:
+        return 0
+    fields = [field.attname for field in Notice._meta.fields if not field.primary_key]
+    for notice in notices:
+        archived_notice = ArchivedNotice(original_id=notice.pk,
+                                         **dict([(name, getattr(notice, name)) for name in fields]))
+        archived_notice.archived = True
+        archived_notice.save(force_insert=True)
+    Notice.objects.filter(pk__in=[notice.pk for notice in notices]).delete()
+    return len(notices)
+_archive_range = transaction.commit_on_success(_archive_range)
+
+def backfill_notice_contexts(pause=0):
+    """
+    Fills in ``context_content_type`` and ``context_object_id`` of the
+    notices (archived or not) that only have a ``context``, as all notices
+    created before those columns existed do. The context views and feeds
+    only find notices by those columns. Runs one update per
+    ActivityContext, sleeping ``pause`` seconds after each one that had
+    notices to update, and returns the number of updated notices.
+    """
+    updated = 0
+    start_time = time.time()
+    contexts = ActivityContext.objects.values_list("pk", "content_type", "object_id")
+    for context_id, content_type_id, object_id in contexts.iterator():
+        context_updated = 0
+        for model in (Notice, ArchivedNotice):
+            context_updated += model.objects.filter(context=context_id,
+                context_content_type__isnull=True).update(
+                context_content_type=content_type_id, context_object_id=object_id)
+        updated += context_updated
+        if context_updated and pause:
+            time.sleep(pause)
+
+    elapsed = time.time() - start_time
+    logging.info("")
+    logging.info("%s notices updated" % updated)
+    logging.info("done in %.2f seconds (%.1f rows/sec)" % (elapsed, updated / max(elapsed, 0.001)))
+    return updated
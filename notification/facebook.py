@@ -80,6 +80,8 @@ class GraphAPI(object):
     get_user_from_cookie() method below to get the OAuth access token
     for the active user from the cookie saved by the SDK.
     """
+    graph_url = "https://graph.facebook.com/"
+
     def __init__(self, access_token=None):
         self.access_token = access_token
 
@@ -168,7 +170,7 @@ class GraphAPI(object):
             else:
                 args["access_token"] = self.access_token
         post_data = None if post_args is None else urllib.urlencode(post_args)
-        file = urllib.urlopen("https://graph.facebook.com/" + path + "?" +
+        file = urllib.urlopen(self.graph_url + path + "?" +
                               urllib.urlencode(args), post_data)
         try:
             response = _parse_json(file.read())
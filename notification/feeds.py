@@ -2,13 +2,13 @@ from datetime import datetime
 
 from django.core.urlresolvers import reverse
 from django.conf import settings
-from django.contrib.sites.models import Site
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
 from django.shortcuts import get_object_or_404
 from django.template.defaultfilters import linebreaks, escape, striptags
-from django.utils.translation import ugettext_lazy as _
+from django.utils.translation import ugettext as _
 
-from notification.models import Notice
+from notification.models import Notice, get_send_environment
 from notification.atomformat import Feed
 
 ITEMS_PER_FEED = getattr(settings, 'ITEMS_PER_FEED', 20)
@@ -16,7 +16,7 @@ ITEMS_PER_FEED = getattr(settings, 'ITEMS_PER_FEED', 20)
 class BaseNoticeFeed(Feed):
     def item_id(self, notification):
         return "http://%s%s" % (
-            Site.objects.get_current().domain,
+            get_send_environment().domain,
             notification.get_absolute_url(),
         )
     
@@ -44,7 +44,7 @@ class NoticeUserFeed(BaseNoticeFeed):
 
     def feed_id(self, user):
         return "http://%s%s" % (
-                Site.objects.get_current().domain,
+                get_send_environment().domain,
                 reverse('notification_feed_for_user'),
             )
 
@@ -62,30 +62,41 @@ class NoticeUserFeed(BaseNoticeFeed):
 
     def feed_links(self, user):
         complete_url = "http://%s%s" % (
-                Site.objects.get_current().domain,
+                get_send_environment().domain,
                 reverse('notification_notices'),
             )
         return ({'href': complete_url},)
 
     def items(self, user):
-        return Notice.objects.notices_for(user).order_by("-added")[:ITEMS_PER_FEED]
+        return Notice.objects.notices_for(user).select_related("user").order_by("-added")[:ITEMS_PER_FEED]
 
 
 class ContextNoticeFeed(BaseNoticeFeed):
     def get_object(self, params):
-        return get_object_or_404(User, username=params[0].lower())
-
-    def feed_id(self, user, context):
+        context, object_id, username = params
+        if context not in getattr(settings, "NOTIFICATION_CONTEXTS", {}):
+            raise LookupError("Unknown context %s" % context)
+        app, model = settings.NOTIFICATION_CONTEXTS[context].split('.')
+        context_type = ContentType.objects.get_by_natural_key(app, model)
+        user = get_object_or_404(User, username=username.lower())
+        return user, context, context_type, object_id
+
+    def notices(self, obj):
+        user, context, context_type, object_id = obj
+        return Notice.objects.notices_for(user, context_type=context_type, context_object_id=object_id)
+
+    def feed_id(self, obj):
+        user, context, context_type, object_id = obj
         return "http://%s%s" % (
-                Site.objects.get_current().domain,
-                reverse('notification_context_feed_for_user'),
+                get_send_environment().domain,
+                reverse('notification_context_feed_for_user', kwargs={"context": context, "object_id": object_id}),
             )
 
-    def feed_title(self, user, context):
-        return _('Notices Feed for %s' % context)
+    def feed_title(self, obj):
+        return _('Notices Feed for %s') % obj[1]
 
-    def feed_updated(self, user, context):
-        qs = Notice.objects.filter(user=user, context=context)
+    def feed_updated(self, obj):
+        qs = self.notices(obj)
         # We return an arbitrary date if there are no results, because there
         # must be a feed_updated field as per the Atom specifications, however
         # there is no real data to go by, and an arbitrary date can be static.
@@ -93,12 +104,13 @@ class ContextNoticeFeed(BaseNoticeFeed):
             return datetime(year=2008, month=7, day=1)
         return qs.latest('added').added
 
-    def feed_links(self, user, context):
+    def feed_links(self, obj):
+        user, context, context_type, object_id = obj
         complete_url = "http://%s%s" % (
-                Site.objects.get_current().domain,
-                reverse('notification_context_notices'),
+                get_send_environment().domain,
+                reverse('notification_context_notices', kwargs={"context": context, "object_id": object_id}),
             )
         return ({'href': complete_url},)
 
-    def items(self, user, context):
-        return Notice.objects.notices_for(user, context=context).order_by("-added")[:ITEMS_PER_FEED]
\ No newline at end of file
+    def items(self, obj):
+        return self.notices(obj).select_related("user").order_by("-added")[:ITEMS_PER_FEED]
@@ -0,0 +1,272 @@
+"""
+Locks that keep two ``emit_notices`` (or ``send_digests``, ...) runs from
+working at the same time, and that a later run can take over when their
+holder died without releasing them.
+
+The holder refreshes a heartbeat every ``NOTIFICATION_LOCK_HEARTBEAT``
+seconds from a background thread. A lock whose heartbeat is older than
+``NOTIFICATION_LOCK_STALE_AFTER`` seconds, or whose holder process is gone
+(checked when it is on the same host), is stale and is taken over by the
+next ``acquire()``. If the holder finds out that its lock was taken over,
+``lost`` becomes True so it can stop.
+
+``NOTIFICATION_LOCK_BACKEND`` picks the implementation: ``"file"`` (the
+default) keeps the lock in a file next to the working directory,
+``"database"`` in the ``EngineLock`` table, which works across hosts
+without a shared filesystem::
+
+    lock = get_lock("send_notices")
+    lock.acquire(timeout)  # raises AlreadyLocked or LockTimeout
+    try:
+        ...
+    finally:
+        lock.release()
+"""
+import os
+import time
+import errno
+import socket
+import logging
+import datetime
+import threading
+
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError
+
+try:
+    from lockfile import AlreadyLocked, LockTimeout
+except ImportError:
+    from notification.lockfile import AlreadyLocked, LockTimeout
+
+# "file" or "database"
+LOCK_BACKEND = getattr(settings, "NOTIFICATION_LOCK_BACKEND", "file")
+
+# how often (in seconds) the holder of a lock refreshes its heartbeat, and
+# how old the heartbeat may get before the lock is taken over
+LOCK_HEARTBEAT = getattr(settings, "NOTIFICATION_LOCK_HEARTBEAT", 10)
+LOCK_STALE_AFTER = getattr(settings, "NOTIFICATION_LOCK_STALE_AFTER", 60)
+
+
+def get_lock(name):
+    """
+    Returns a lock named ``name`` of the configured backend.
+    """
+    if LOCK_BACKEND == "database":
+        return DatabaseLock(name)
+    return HeartbeatFileLock(name)
+
+
+def process_exists(pid):
+    """
+    Whether a process with this pid runs on this host. One we may not
+    signal counts, it exists.
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+class HeartbeatLock(object):
+    """
+    The waiting and heartbeat logic shared by the lock backends; subclasses
+    implement ``_try_acquire``, ``_beat`` and ``_release``.
+    """
+    def __init__(self, name, heartbeat=LOCK_HEARTBEAT, stale_after=LOCK_STALE_AFTER):
+        self.name = name
+        self.heartbeat = heartbeat
+        self.stale_after = stale_after
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        self.owner = "%s:%s:%s" % (self.host, self.pid, os.urandom(8).encode("hex"))
+        self.lost = False
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def acquire(self, timeout=None):
+        """
+        Takes the lock, waiting for it forever if ``timeout`` is None or up to
+        ``timeout`` seconds. Raises AlreadyLocked if ``timeout`` is 0 or less
+        and the lock is held, LockTimeout if the time is up.
+        """
+        end_time = None
+        if timeout is not None:
+            end_time = time.time() + max(timeout, 0)
+        while not self._try_acquire():
+            if end_time is not None and time.time() >= end_time:
+                if timeout > 0:
+                    raise LockTimeout
+                raise AlreadyLocked
+            time.sleep(timeout and min(timeout / 10.0, 1) or 0.1)
+        self.lost = False
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._keep_alive)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def release(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.lost:
+            logging.warning("lock %s was taken over by another process." % self.name)
+        else:
+            self._release()
+
+    def _keep_alive(self):
+        try:
+            while not self._stopping.isSet():
+                self._stopping.wait(self.heartbeat)
+                if self._stopping.isSet():
+                    break
+                if not self._beat():
+                    logging.error("lock %s was taken over by another process." % self.name)
+                    self.lost = True
+                    break
+        finally:
+            # the thread's own database connection
+            connection.close()
+
+    def _is_stale(self, host, pid, heartbeat):
+        if time.time() - heartbeat > self.stale_after:
+            return True
+        return host == self.host and pid and not process_exists(pid)
+
+
+class HeartbeatFileLock(HeartbeatLock):
+    """
+    A lock file created with O_EXCL that holds the owner, pid and host of
+    the holder. Its modification time is the heartbeat.
+    """
+    def __init__(self, name, **kwargs):
+        HeartbeatLock.__init__(self, name, **kwargs)
+        self.lock_file = os.path.abspath(name) + ".lock"
+
+    def _read(self, path):
+        try:
+            info = open(path).read().split("\n")
+        except IOError:
+            return None
+        owner, host, pid = (info + ["", "", ""])[:3]
+        try:
+            pid = int(pid)
+        except ValueError:
+            pid = None
+        return owner, host, pid
+
+    def _try_acquire(self):
+        try:
+            fd = os.open(self.lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0644)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            if not self._break_if_stale():
+                return False
+            try:
+                fd = os.open(self.lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0644)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+                return False
+        try:
+            os.write(fd, "%s\n%s\n%s\n" % (self.owner, self.host, self.pid))
+        finally:
+            os.close(fd)
+        return True
+
+    def _break_if_stale(self):
+        """
+        Removes the lock file if it is stale and returns whether it did.
+        """
+        try:
+            stat = os.stat(self.lock_file)
+        except OSError:
+            return False
+        info = self._read(self.lock_file)
+        if info is None:
+            return False
+        owner, host, pid = info
+        if not self._is_stale(host, pid, stat.st_mtime):
+            return False
+        # move it out of the way first so that two runs breaking the lock at
+        # the same time can't remove a lock one of them just took
+        moved = "%s.%s" % (self.lock_file, self.owner.replace(":", "."))
+        try:
+            os.rename(self.lock_file, moved)
+        except OSError:
+            return False
+        moved_stat = os.stat(moved)
+        broken = (moved_stat.st_ino, moved_stat.st_mtime) == (stat.st_ino, stat.st_mtime)
+        if broken:
+            logging.warning("breaking stale lock %s of %s (pid %s)." % (self.lock_file, host, pid))
+        else:
+            # somebody else's fresh lock, put it back
+            try:
+                os.link(moved, self.lock_file)
+            except OSError:
+                pass
+        os.unlink(moved)
+        return broken
+
+    def _is_mine(self):
+        info = self._read(self.lock_file)
+        return info is not None and info[0] == self.owner
+
+    def _beat(self):
+        if not self._is_mine():
+            return False
+        os.utime(self.lock_file, None)
+        return True
+
+    def _release(self):
+        if self._is_mine():
+            os.unlink(self.lock_file)
+
+
+class DatabaseLock(HeartbeatLock):
+    """
+    A row in the ``EngineLock`` table. Taking over a stale lock is a
+    conditional update on the heartbeat that was read, so only one of the
+    runs trying at the same time succeeds. Heartbeats are written with each
+    host's clock, which must be off by much less than
+    ``NOTIFICATION_LOCK_STALE_AFTER``.
+    """
+    def _try_acquire(self):
+        from notification.models import EngineLock
+        now = datetime.datetime.now()
+        try:
+            self._create(now)
+            return True
+        except IntegrityError:
+            pass
+        try:
+            lock = EngineLock.objects.get(name=self.name)
+        except EngineLock.DoesNotExist:
+            # released in the meantime
+            return False
+        if not self._is_stale(lock.host, lock.pid, time.mktime(lock.heartbeat.timetuple())):
+            return False
+        taken = EngineLock.objects.filter(name=self.name, owner=lock.owner,
+                                          heartbeat=lock.heartbeat).update(
+            owner=self.owner, host=self.host, pid=self.pid, acquired=now, heartbeat=now)
+        if taken:
+            logging.warning("took over stale lock %s of %s (pid %s)." % (self.name, lock.host, lock.pid))
+        return bool(taken)
+
+    def _create(self, now):
+        # committed right away, the other runs must see it
+        from notification.models import EngineLock
+        EngineLock.objects.create(name=self.name, owner=self.owner, host=self.host,
+                                  pid=self.pid, acquired=now, heartbeat=now)
+    _create = transaction.commit_on_success(_create)
+
+    def _beat(self):
+        from notification.models import EngineLock
+        return bool(EngineLock.objects.filter(name=self.name, owner=self.owner).update(
+            heartbeat=datetime.datetime.now()))
+
+    def _release(self):
+        from notification.models import EngineLock
+        EngineLock.objects.filter(name=self.name, owner=self.owner).delete()
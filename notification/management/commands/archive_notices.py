@@ -0,0 +1,24 @@
+
+import logging
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from notification.engine import archive_notices, ARCHIVE_AFTER
+
+class Command(NoArgsCommand):
+    help = "Move archived and old notices to the archive table."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--days', dest='days', type='int', default=ARCHIVE_AFTER,
+            help='Also move notices older than this many days.'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=1000,
+            help='Size of the primary key ranges moved per transaction.'),
+        make_option('--pause', dest='pause', type='float', default=0,
+            help='Seconds to sleep after each range.'),
+    )
+    
+    def handle_noargs(self, **options):
+        logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+        logging.info("-" * 72)
+        archive_notices(max_age=options['days'], chunk_size=options['chunk_size'],
+                        pause=options['pause'])
@@ -0,0 +1,19 @@
+
+import logging
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from notification.engine import backfill_notice_contexts
+
+class Command(NoArgsCommand):
+    help = "Fill in the context columns of notices created before they existed."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--pause', dest='pause', type='float', default=0,
+            help='Seconds to sleep after each context.'),
+    )
+    
+    def handle_noargs(self, **options):
+        logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+        logging.info("-" * 72)
+        backfill_notice_contexts(pause=options['pause'])
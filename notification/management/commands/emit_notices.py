@@ -1,15 +1,130 @@
 
+import os
+import signal
 import logging
+from optparse import make_option
+
+try:
+    import json
+except ImportError:
+    import django.utils.simplejson as json
 
 from django.core.management.base import NoArgsCommand
 
-from notification.engine import send_all
+from notification.engine import send_all, send_forever
+
+class SamplingProfiler(object):
+    """
+    Samples the stack every ``interval`` seconds of CPU time and counts how
+    often each stack was seen. ``write`` outputs them in the "collapsed"
+    format flamegraph.pl and speedscope read.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.samples = {}
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        stack.reverse()
+        key = ";".join(stack)
+        self.samples[key] = self.samples.get(key, 0) + 1
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self._sample)
+        # restart the system calls the samples land in instead of failing
+        # them with EINTR
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def write(self, path):
+        output = open(path, "w")
+        try:
+            for stack, count in sorted(self.samples.items()):
+                output.write("%s %d\n" % (stack, count))
+        finally:
+            output.close()
 
 class Command(NoArgsCommand):
     help = "Emit queued notices."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--daemon', action='store_true', dest='daemon', default=False,
+            help='Keep running, polling the queue, until SIGTERM.'),
+        make_option('--lanes', dest='lanes', default=None,
+            help='Comma separated priorities; only send batches with these.'),
+        make_option('--processes', dest='processes', type='int', default=None,
+            help='Render and deliver batches in this many worker processes.'),
+        make_option('--delivery-threads', dest='delivery_threads', type='int', default=None,
+            help='Send the emails and facebook posts of a batch concurrently in this many threads.'),
+        make_option('--limit', dest='limit', type='int', default=None,
+            help='Stop after sending this many batches.'),
+        make_option('--max-seconds', dest='max_seconds', type='float', default=None,
+            help='Do not start new batches after this many seconds.'),
+        make_option('--profile', dest='profile', default=None,
+            help='Write cProfile stats (readable with pstats) to this file.'),
+        make_option('--sample', dest='sample', default=None,
+            help='Write sampled stacks in collapsed (flamegraph) format to this file.'),
+        make_option('--sample-interval', dest='sample_interval', type='float', default=0.005,
+            help='Seconds of CPU time between stack samples (default 0.005).'),
+        make_option('--report', action='store_true', dest='report', default=False,
+            help='Log per-batch and per-label timing tables.'),
+        make_option('--summary', dest='summary', default=None,
+            help='Write a JSON summary of the run to this file ("-" for stdout).'),
+    )
     
     def handle_noargs(self, **options):
         logging.basicConfig(level=logging.DEBUG, format="%(message)s")
         logging.info("-" * 72)
-        send_all()
-    
\ No newline at end of file
+
+        kwargs = {"limit": options['limit'], "max_seconds": options['max_seconds'],
+                  "processes": options['processes'], "delivery_threads": options['delivery_threads']}
+        if options['lanes']:
+            kwargs["lanes"] = [int(lane) for lane in options['lanes'].split(",")]
+        if options['daemon']:
+            send_forever(**kwargs)
+            return
+        sampler = None
+        if options['sample']:
+            sampler = SamplingProfiler(options['sample_interval'])
+            sampler.start()
+        try:
+            if options['profile']:
+                try:
+                    import cProfile as profile
+                except ImportError:
+                    import profile
+                profiler = profile.Profile()
+                summary = profiler.runcall(send_all, **kwargs)
+                profiler.dump_stats(options['profile'])
+            else:
+                summary = send_all(**kwargs)
+        finally:
+            if sampler is not None:
+                sampler.stop()
+                sampler.write(options['sample'])
+
+        if options['report']:
+            self.log_report(summary)
+        if options['summary'] == '-':
+            print json.dumps(summary, indent=2, default=str)
+        elif options['summary']:
+            open(options['summary'], "w").write(json.dumps(summary, indent=2, default=str))
+
+    def log_report(self, summary):
+        logging.info("")
+        logging.info("%-10s %8s %10s" % ("batch", "notices", "seconds"))
+        for batch in summary["batch_timings"]:
+            logging.info("%-10s %8d %10.3f" % (batch["id"], batch["notices"], batch["seconds"]))
+        logging.info("")
+        logging.info("%-40s %8s %10s %10s" % ("label", "sent", "seconds", "avg (ms)"))
+        labels = sorted(summary["labels"].items(), key=lambda item: item[1]["seconds"], reverse=True)
+        for label, stats in labels:
+            logging.info("%-40s %8d %10.3f %10.1f" % (label, stats["sent"], stats["seconds"],
+                                                     1000 * stats["seconds"] / stats["sent"]))
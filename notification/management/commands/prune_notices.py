@@ -0,0 +1,24 @@
+
+import logging
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from notification.engine import prune_notices
+
+class Command(NoArgsCommand):
+    help = "Delete the notices that the NOTIFICATION_RETENTION policies don't keep."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int', default=1000,
+            help='Number of primary keys deleted per statement.'),
+        make_option('--pause', dest='pause', type='float', default=0,
+            help='Seconds to sleep after each deleted chunk.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Only count the notices that would be deleted.'),
+    )
+    
+    def handle_noargs(self, **options):
+        logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+        logging.info("-" * 72)
+        prune_notices(chunk_size=options['chunk_size'], pause=options['pause'],
+                      dry_run=options['dry_run'])
@@ -0,0 +1,26 @@
+
+import logging
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from notification.engine import replay_failed_notices
+
+class Command(NoArgsCommand):
+    help = "Queue the notices of failed batches again."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--label', action='append', dest='labels', default=[],
+            help='Only replay batches of this notice type (can be repeated).'),
+        make_option('--error-type', action='append', dest='error_types', default=[],
+            help='Only replay batches that failed with this exception class (can be repeated).'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=1000,
+            help='Batches queued per transaction.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Only count the batches that would be queued.'),
+    )
+    
+    def handle_noargs(self, **options):
+        logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+        logging.info("-" * 72)
+        replay_failed_notices(labels=options['labels'], error_types=options['error_types'],
+                              chunk_size=options['chunk_size'], dry_run=options['dry_run'])
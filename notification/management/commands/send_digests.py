@@ -0,0 +1,14 @@
+
+import logging
+
+from django.core.management.base import NoArgsCommand
+
+from notification.engine import send_digests
+
+class Command(NoArgsCommand):
+    help = "Send the pending email digests."
+    
+    def handle_noargs(self, **options):
+        logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+        logging.info("-" * 72)
+        send_digests()
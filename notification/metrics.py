@@ -0,0 +1,132 @@
+"""
+Timing instrumentation for the send pipeline.
+
+Every stage of ``send_now`` and ``engine.send_all`` is timed with
+``record_stage``, which updates the in-process ``metrics`` registry and
+sends the ``stage_timed`` signal::
+
+    from notification.metrics import stage_timed, metrics
+
+    def log_slow_stage(sender, stage, label, medium, duration, **kwargs):
+        if duration > 1:
+            logging.warning("%s for %s took %.2fs" % (stage, label, duration))
+    stage_timed.connect(log_slow_stage)
+
+    metrics.snapshot()  # counters and latency histograms by stage, label and medium
+
+Set ``NOTIFICATION_METRICS = False`` to turn it off.
+"""
+import time
+import bisect
+import threading
+
+from django.conf import settings
+from django.dispatch import Signal
+
+ENABLED = getattr(settings, "NOTIFICATION_METRICS", True)
+
+# upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = getattr(settings, "NOTIFICATION_METRICS_BUCKETS",
+                  (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0))
+
+stage_timed = Signal(providing_args=["stage", "label", "medium", "duration"])
+
+
+class Histogram(object):
+    """
+    Latency histogram with fixed buckets. ``counts[i]`` is the number of
+    observations less than or equal to ``BUCKETS[i]``, the last one counts
+    everything above the largest bucket.
+    """
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def as_dict(self):
+        return {
+            "buckets": list(BUCKETS),
+            "counts": list(self.counts),
+            "count": self.count,
+            "total": self.total,
+            "max": self.max,
+        }
+
+
+class MetricsRegistry(object):
+    """
+    Counters and latency histograms keyed by (name, label, medium).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def incr(self, name, label=None, medium=None, value=1):
+        key = (name, label, medium)
+        self._lock.acquire()
+        try:
+            self.counters[key] = self.counters.get(key, 0) + value
+        finally:
+            self._lock.release()
+
+    def observe(self, name, duration, label=None, medium=None):
+        key = (name, label, medium)
+        self._lock.acquire()
+        try:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(duration)
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """
+        Returns the current values as a list of dictionaries, suitable for
+        json.dumps.
+        """
+        self._lock.acquire()
+        try:
+            rows = []
+            for (name, label, medium), value in self.counters.items():
+                rows.append({"type": "counter", "name": name, "label": label,
+                             "medium": medium, "value": value})
+            for (name, label, medium), histogram in self.histograms.items():
+                row = histogram.as_dict()
+                row.update({"type": "histogram", "name": name, "label": label, "medium": medium})
+                rows.append(row)
+            return rows
+        finally:
+            self._lock.release()
+
+metrics = MetricsRegistry()
+
+
+def record_stage(stage, started, label=None, medium=None):
+    """
+    Records that ``stage`` ran from ``started`` (a ``time.time()`` value)
+    until now and returns the current time, so consecutive stages can be
+    chained::
+
+        started = time.time()
+        ...
+        started = record_stage("render", started, label)
+    """
+    now = time.time()
+    if ENABLED:
+        duration = now - started
+        metrics.observe(stage, duration, label, medium)
+        stage_timed.send(sender=None, stage=stage, label=label, medium=medium, duration=duration)
+    return now
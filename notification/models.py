@@ -1,14 +1,20 @@
+import time
+import socket
 import datetime
+import threading
 
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import Q
 from django.db.models.query import QuerySet
 from django.conf import settings
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
+from django.db.models.signals import post_save, post_delete
 from django.template import Context
 from django.template.loader import render_to_string
 
@@ -26,9 +32,13 @@ from django.utils.translation import ugettext, get_language, activate
 try:
     from facebook import GraphAPI
     from decorators import daemonize
+    from metrics import metrics, record_stage
+    from delivery import get_pool as get_delivery_pool
 except ImportError:
     from notification.facebook import GraphAPI
     from notification.decorators import daemonize
+    from notification.metrics import metrics, record_stage
+    from notification.delivery import get_pool as get_delivery_pool
 # favour django-mailer but fall back to django.core.mail
 if 'mailer' in settings.INSTALLED_APPS:
     from mailer import send_mail
@@ -40,6 +50,25 @@ QUEUE_ALL = getattr(settings, "NOTIFICATION_QUEUE_ALL", False)
 LAZY_RENDERING = getattr(settings, "LAZY_NOTIFICATION_RENDERING", False) #whether to store contexts or full rendered templates
 FACEBOOK_ATTR = getattr(settings, "NOTIFICATION_FACEBOOK_ATTR", 'facebook_access_token')
 PROFILES_ACTIVATED = getattr(settings, "AUTH_PROFILE_MODULE", False)
+# priority of queued notices whose notice type doesn't set one, lower is sent first
+DEFAULT_PRIORITY = getattr(settings, "NOTIFICATION_DEFAULT_PRIORITY", 5)
+# path of the Unix socket queue() uses to wake up emit_notices --daemon
+WAKEUP_SOCKET = getattr(settings, "NOTIFICATION_WAKEUP_SOCKET", None)
+# how often (in seconds) a process checks the shared cache for notice type
+# changes made by other processes, and remembers that a label doesn't exist
+NOTICE_TYPE_CHECK_INTERVAL = getattr(settings, "NOTIFICATION_NOTICE_TYPE_CHECK_INTERVAL", 5)
+# how many ActivityContext ids each process remembers
+CONTEXT_CACHE_SIZE = getattr(settings, "NOTIFICATION_CONTEXT_CACHE_SIZE", 10000)
+# how long (in seconds) the language of each user is cached
+LANGUAGE_CACHE_TIMEOUT = getattr(settings, "NOTIFICATION_LANGUAGE_CACHE_TIMEOUT", 300)
+# how long (in seconds) an idempotency key keeps a notice from being sent again
+IDEMPOTENCY_WINDOW = getattr(settings, "NOTIFICATION_IDEMPOTENCY_WINDOW", 86400)
+# run AUTO_NOTIFY callbacks at the end of the request instead of inside save()
+DEFER_AUTO_NOTIFY = getattr(settings, "NOTIFICATION_DEFER_AUTO_NOTIFY", False)
+# whether deferred AUTO_NOTIFY callbacks queue their notices instead of sending them
+AUTO_NOTIFY_QUEUE = getattr(settings, "NOTIFICATION_AUTO_NOTIFY_QUEUE", True)
+
+_auto_notify_state = threading.local()
 
 
 class LanguageStoreNotAvailable(Exception):
@@ -47,13 +76,20 @@ class LanguageStoreNotAvailable(Exception):
 
 class NoticeType(models.Model):
 
-    label = models.CharField(_('label'), max_length=40)
+    label = models.CharField(_('label'), max_length=40, unique=True)
     display = models.CharField(_('display'), max_length=50)
     description = models.CharField(_('description'), max_length=100)
 
     # by default only on for media with sensitivity less than or equal to this number
     default = models.IntegerField(_('default'))
 
+    # priority of the queued batches of this type, lower is sent first
+    priority = models.IntegerField(_('priority'), default=DEFAULT_PRIORITY)
+
+    # notices of this type sent to a user within this many seconds of an
+    # unseen one for the same context are merged into it. 0 disables it.
+    coalesce_window = models.PositiveIntegerField(_('coalesce window'), default=0)
+
     def __unicode__(self):
         return self.label
 
@@ -62,16 +98,101 @@ class NoticeType(models.Model):
         verbose_name_plural = _("notice types")
 
 
+class NoticeTypeRegistry(object):
+    """
+    In-process registry of all the notice types, loaded with a single query.
+
+    Saving or deleting a NoticeType clears the registry of the current process
+    and bumps a version number in the cache. Other processes sharing the
+    cache check the version at most every ``check_interval`` seconds and
+    reload theirs when it changed. Labels that don't exist are remembered
+    for as long. A rolled back transaction sends no signals, so call
+    ``clear()`` after rolling back changes to notice types (the test cases
+    do).
+    """
+    version_key = 'notification_notice_types_version'
+
+    def __init__(self, check_interval=NOTICE_TYPE_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._by_label = None
+        self._by_id = None
+        self._version = None
+        self._checked = 0
+        self._missing = {}
+
+    def _load(self):
+        """
+        Returns the (by id, by label) dictionaries, loading them if needed.
+        They are returned rather than read back from the attributes, which
+        another thread may clear at any time.
+        """
+        by_id, by_label = self._by_id, self._by_label
+        now = time.time()
+        if by_id is not None and by_label is not None and now - self._checked < self.check_interval:
+            return by_id, by_label
+        version = cache.get(self.version_key)
+        if by_id is None or by_label is None or version != self._version:
+            notice_types = list(NoticeType.objects.all())
+            by_id = dict([(notice_type.pk, notice_type) for notice_type in notice_types])
+            by_label = dict([(notice_type.label, notice_type) for notice_type in notice_types])
+            self._by_id, self._by_label, self._version = by_id, by_label, version
+            self._missing = {}
+        self._checked = now
+        return by_id, by_label
+
+    def get(self, label):
+        """
+        Returns the NoticeType with the given label or raises
+        NoticeType.DoesNotExist.
+        """
+        by_label = self._load()[1]
+        if label in by_label:
+            return by_label[label]
+        missed = self._missing.get(label)
+        if missed is None or time.time() - missed >= self.check_interval:
+            # it might have been created by a process that can't bump our cache
+            self.clear()
+            by_label = self._load()[1]
+            if label in by_label:
+                return by_label[label]
+            self._missing[label] = time.time()
+        raise NoticeType.DoesNotExist("No NoticeType with label %r" % label)
+
+    def get_by_id(self, pk):
+        try:
+            return self._load()[0][pk]
+        except KeyError:
+            return NoticeType.objects.get(pk=pk)
+
+    def all(self):
+        return sorted(self._load()[0].values(), key=lambda notice_type: notice_type.pk)
+
+    def clear(self):
+        self._by_label = None
+        self._by_id = None
+        self._missing = {}
+
+    def invalidate(self, **kwargs):
+        self.clear()
+        cache.set(self.version_key, time.time())
+
+notice_types = NoticeTypeRegistry()
+post_save.connect(notice_types.invalidate, sender=NoticeType, weak=False)
+post_delete.connect(notice_types.invalidate, sender=NoticeType, weak=False)
+
+
 # if this gets updated, the create() method below needs to be as well...
 NOTICE_MEDIA = (
     ("1", _("Email")),
     ("2", _("Facebook")),
+    ("3", _("Email digest")),
 )
 
 # how spam-sensitive is the medium
 NOTICE_MEDIA_DEFAULTS = {
     "1": 2, # email
     "2": 3,# facebook
+    "3": 4, # email digest
 }
 
 class NoticeSetting(models.Model):
@@ -102,32 +223,148 @@ def get_notification_setting(user, notice_type, medium):
 def should_send(user, notice_type, medium):
     return get_notification_setting(user, notice_type, medium).send
 
+def get_notification_settings(users, notice_types):
+    """
+    Returns a dictionary mapping (user id, notice type id, medium) to the
+    NoticeSetting of every combination of the given users, notice types and
+    NOTICE_MEDIA, using a single query. Missing settings are returned as
+    unsaved NoticeSettings with the default value.
+    """
+    settings_map = {}
+    if not users or not notice_types:
+        return settings_map
+    for setting in NoticeSetting.objects.filter(user__in=[user.id for user in users],
+                                                notice_type__in=[notice_type.id for notice_type in notice_types]):
+        settings_map[(setting.user_id, setting.notice_type_id, setting.medium)] = setting
+    for user in users:
+        for notice_type in notice_types:
+            for medium, medium_display in NOTICE_MEDIA:
+                key = (user.id, notice_type.id, medium)
+                if key not in settings_map:
+                    default = (NOTICE_MEDIA_DEFAULTS[medium] <= notice_type.default)
+                    settings_map[key] = NoticeSetting(user=user, notice_type=notice_type,
+                                                      medium=medium, send=default)
+    return settings_map
+
+
+class CombinedNotices(object):
+    """
+    The notices of two querysets, merged newest first (the first queryset's
+    go first when they were added at the same time). Supports what the
+    views, feeds and Paginator need: count(), len(), filter(), iteration and
+    slicing.
+
+    A slice doesn't load the notices before it. A binary search, which reads
+    one row of each queryset per step, finds how many of those notices each
+    queryset has; the slice is then read from each queryset from that
+    (added, id) bound on.
+    """
+    def __init__(self, first, second):
+        self.querysets = [first.order_by("-added", "-pk"), second.order_by("-added", "-pk")]
+        self._counts = None
+
+    def counts(self):
+        if self._counts is None:
+            self._counts = [qs.count() for qs in self.querysets]
+        return self._counts
+
+    def count(self):
+        return sum(self.counts())
+
+    def __len__(self):
+        return self.count()
+
+    def filter(self, *args, **kwargs):
+        return CombinedNotices(*[qs.filter(*args, **kwargs) for qs in self.querysets])
+
+    def _bound(self, qs, offset):
+        return qs.values_list("added", "pk")[offset]
+
+    def _split(self, start):
+        """
+        Returns how many of the first ``start`` merged notices come from the
+        first queryset.
+        """
+        first, second = self.querysets
+        counts = self.counts()
+        low, high = max(0, start - counts[1]), min(start, counts[0])
+        while low < high:
+            middle = (low + high) // 2
+            # if the first queryset's notice at ``middle`` goes before the
+            # last one taken from the second, more come from the first
+            if self._bound(first, middle)[0] >= self._bound(second, start - middle - 1)[0]:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def __getitem__(self, k):
+        if not isinstance(k, slice):
+            return self[k:k + 1][0]
+        start, stop = k.start or 0, k.stop
+        assert start >= 0 and (stop is None or stop >= 0), "Negative indexing is not supported."
+        if stop is None:
+            stop = self.count()
+        if start >= stop:
+            return []
+        if start:
+            first_start = self._split(start)
+            offsets = [first_start, start - first_start]
+        else:
+            offsets = [0, 0]
+        notices = []
+        for rank, (qs, offset) in enumerate(zip(self.querysets, offsets)):
+            if offset:
+                if offset >= self.counts()[rank]:
+                    continue
+                added, pk = self._bound(qs, offset)
+                qs = qs.filter(Q(added__lt=added) | Q(added=added, pk__lte=pk))
+            notices.extend([(notice.added, -rank, notice.pk, notice) for notice in qs[:stop - start]])
+        notices.sort(reverse=True)
+        return [notice for added, rank, pk, notice in notices[:stop - start]][::k.step or 1]
+
+    def __iter__(self):
+        return iter(self[:])
 
 class NoticeManager(models.Manager):
 
-    def notices_for(self, user, archived=False, unseen=None, on_site=None, context = None):
+    def notices_for(self, user, archived=False, unseen=None, on_site=None, context = None,
+                    context_type=None, context_object_id=None):
         """
         returns Notice objects for the given user.
 
         If archived=False, it only include notices not archived.
-        If archived=True, it returns all notices for that user.
+        If archived=True, it returns all notices for that user, including the
+        ones moved to ArchivedNotice, as a CombinedNotices.
 
         If unseen=None, it includes all notices.
         If unseen=True, return only unseen notices.
         If unseen=False, return only seen notices.
         If context != None, return only notices for the given context
+        If context_type and context_object_id are given, return only notices
+        for the context with that ContentType and id (without loading it)
         """
         if archived:
             qs = self.filter(user=user)
         else:
             qs = self.filter(user=user, archived=archived)
+        qs = self._filter(qs, unseen, on_site, context, context_type, context_object_id)
+        if archived and self.model is Notice:
+            archived_qs = self._filter(ArchivedNotice.objects.filter(user=user),
+                                       unseen, on_site, context, context_type, context_object_id)
+            return CombinedNotices(qs, archived_qs)
+        return qs
+
+    def _filter(self, qs, unseen, on_site, context, context_type, context_object_id):
         if unseen is not None:
             qs = qs.filter(unseen=unseen)
         if on_site is not None:
             qs = qs.filter(on_site=on_site)
         if context:
-            qs = qs.filter(context__content_type=ContentType.objects.get_for_model(context),
-                                                context__object_id=context.pk)
+            context_type = ContentType.objects.get_for_model(context)
+            context_object_id = context.pk
+        if context_type is not None:
+            qs = qs.filter(context_content_type=context_type, context_object_id=context_object_id)
         return qs
 
     def unseen_count_for(self, user, **kwargs):
@@ -137,12 +374,108 @@ class NoticeManager(models.Manager):
         """
         return self.notices_for(user, unseen=True, **kwargs).count()
 
+    def coalescable(self, user, notice_type, context_id=None):
+        """
+        returns the unseen notice of the given type and ActivityContext id
+        that a new notice for the given user should be merged into, or None
+        """
+        if not notice_type.coalesce_window:
+            return None
+        since = datetime.datetime.now() - datetime.timedelta(seconds=notice_type.coalesce_window)
+        # an off-site notice is never shown, merging into it would hide
+        # the new one
+        qs = self.filter(user=user, notice_type=notice_type, context=context_id, on_site=True,
+                         unseen=True, archived=False, added__gte=since).order_by("-added")
+        try:
+            return qs[0]
+        except IndexError:
+            return None
+
+class LRUCache(object):
+    """
+    A small, thread-safe, approximately least-recently-used mapping. When it
+    grows past ``size`` entries the least recently used half is dropped.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._data = {}
+        self._tick = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        self._tick += 1
+        entry[1] = self._tick
+        return entry[0]
+
+    def set(self, key, value):
+        self._lock.acquire()
+        try:
+            self._tick += 1
+            self._data[key] = [value, self._tick]
+            if len(self._data) > self.size:
+                by_age = sorted(self._data.items(), key=lambda item: item[1][1])
+                for old_key, entry in by_age[:len(by_age) // 2]:
+                    del self._data[old_key]
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data = {}
+
+class ActivityContextManager(models.Manager):
+
+    def get_id_for(self, obj, refresh=False):
+        """
+        Returns the id of the ActivityContext for the given object, creating
+        it if needed. Ids are remembered per process, so resolving a context
+        that was already used only hits the database the first time.
+        ``refresh`` looks the id up again, e.g. because the context was
+        deleted by another process.
+
+        An id read inside a transaction that has uncommitted changes isn't
+        remembered, the transaction may have created the context and may
+        still be rolled back.
+        """
+        content_type = ContentType.objects.get_for_model(obj)
+        key = (content_type.pk, obj.pk)
+        context_id = None
+        if refresh:
+            _activity_context_ids.delete(key)
+        else:
+            context_id = _activity_context_ids.get(key)
+        if context_id is None:
+            # (content_type, object_id) is unique, so concurrent senders
+            # can't create duplicates: get_or_create retries the get when
+            # the insert fails with an IntegrityError.
+            context_id = self.get_or_create(content_type=content_type, object_id=obj.pk)[0].pk
+            if not (transaction.is_managed() and transaction.is_dirty()):
+                _activity_context_ids.set(key, context_id)
+        return context_id
+
 class ActivityContext(models.Model):
     content_type = models.ForeignKey(ContentType)
     object_id = models.PositiveIntegerField()
     content_object = generic.GenericForeignKey('content_type', 'object_id')
+
+    objects = ActivityContextManager()
+
+    class Meta:
+        unique_together = ("content_type", "object_id")
+
+_activity_context_ids = LRUCache(CONTEXT_CACHE_SIZE)
+
+def _activity_context_deleted(sender, instance, **kwargs):
+    _activity_context_ids.delete((instance.content_type_id, instance.object_id))
+
+post_delete.connect(_activity_context_deleted, sender=ActivityContext)
     
-class Notice(models.Model):
+class BaseNotice(models.Model):
 
     user = models.ForeignKey(User, verbose_name=_('user'))
     message = models.TextField(_('message'))
@@ -152,6 +485,12 @@ class Notice(models.Model):
     archived = models.BooleanField(_('archived'), default=False)
     on_site = models.BooleanField(_('on site'))
     context = models.ForeignKey(ActivityContext, null=True)
+    # copies of context.content_type and context.object_id so notices can be
+    # filtered by context without a join, see sql/notice.sql
+    context_content_type = models.ForeignKey(ContentType, null=True, related_name="context_%(class)ss")
+    context_object_id = models.PositiveIntegerField(null=True)
+    # how many notices were merged into this one, see NoticeType.coalesce_window
+    count = models.PositiveIntegerField(_('count'), default=1)
 
     objects = NoticeManager()
 
@@ -163,14 +502,9 @@ class Notice(models.Model):
         #don't believe in settings...
         try:
             template_context = pickle.loads(self.message.decode("base64"))
-            return get_formatted_messages(('notice.html',), self.notice_type.label, template_context)['notice.html']
+            return get_formatted_messages(('notice.html',), notice_types.get_by_id(self.notice_type_id).label, template_context)['notice.html']
         except:
             return self.message
-        
-
-    def archive(self):
-        self.archived = True
-        self.save()
 
     def is_unseen(self):
         """
@@ -186,29 +520,183 @@ class Notice(models.Model):
         return unseen
 
     class Meta:
+        abstract = True
         ordering = ["-added"]
+
+    def get_absolute_url(self):
+        return ("notification_notice", [str(self.pk)])
+    get_absolute_url = models.permalink(get_absolute_url)
+
+
+class Notice(BaseNotice):
+
+    def archive(self):
+        self.archived = True
+        self.save()
+
+    class Meta(BaseNotice.Meta):
         verbose_name = _("notice")
         verbose_name_plural = _("notices")
 
+
+class ArchivedNotice(BaseNotice):
+    """
+    A notice moved out of the Notice table by ``engine.archive_notices``.
+    It has an id of its own, since the database may give the id it had as
+    a Notice to a new notice, and keeps that one as ``original_id``.
+    """
+    original_id = models.PositiveIntegerField(_('original id'), db_index=True)
+
+    class Meta(BaseNotice.Meta):
+        verbose_name = _("archived notice")
+        verbose_name_plural = _("archived notices")
+
     def get_absolute_url(self):
-        return ("notification_notice", [str(self.pk)])
+        return ("notification_archived_notice", [str(self.pk)])
     get_absolute_url = models.permalink(get_absolute_url)
 
 
+class DigestItem(models.Model):
+    """
+    A notice waiting to be included in the next email digest of its user.
+    See ``notification.engine.send_digests``.
+    """
+    user = models.ForeignKey(User, verbose_name=_('user'))
+    notice = models.ForeignKey(Notice, verbose_name=_('notice'))
+    added = models.DateTimeField(_('added'), default=datetime.datetime.now, db_index=True)
+
+    class Meta:
+        ordering = ["added"]
+        verbose_name = _("digest item")
+        verbose_name_plural = _("digest items")
+
+
 class NoticeQueueBatch(models.Model):
     """
     A queued notice.
     Denormalized data for a notice.
+
+    Batches are sent in ``priority`` order (lower first) and, within a
+    priority, in the order they were queued, see sql/noticequeuebatch.sql.
+    A batch with a ``send_at`` time isn't sent before then; it can be
+    cancelled until it is sent through its ``key``, see cancel_queued().
+    """
+    pickled_data = models.TextField()
+    priority = models.IntegerField(_('priority'), default=DEFAULT_PRIORITY)
+    send_at = models.DateTimeField(_('send at'), null=True, blank=True, db_index=True)
+    key = models.CharField(_('key'), max_length=255, blank=True, db_index=True)
+    # failed attempts to send the batch so far
+    attempts = models.PositiveIntegerField(_('attempts'), default=0)
+    idempotency_key = models.CharField(_('idempotency key'), max_length=255, blank=True)
+
+
+class FailedNoticeBatch(models.Model):
+    """
+    A queued batch that kept failing, with the notices of it that weren't
+    sent. ``replay_failed_notices`` queues them again.
     """
     pickled_data = models.TextField()
+    label = models.CharField(_('label'), max_length=40, db_index=True)
+    priority = models.IntegerField(_('priority'), default=DEFAULT_PRIORITY)
+    # id of the NoticeQueueBatch it came from
+    batch_id = models.PositiveIntegerField(_('batch id'))
+    attempts = models.PositiveIntegerField(_('attempts'))
+    error_type = models.CharField(_('error type'), max_length=100, db_index=True)
+    error = models.TextField(_('error'))
+    traceback = models.TextField(_('traceback'), blank=True)
+    failed = models.DateTimeField(_('failed'), default=datetime.datetime.now)
+    idempotency_key = models.CharField(_('idempotency key'), max_length=255, blank=True)
 
-def create_notice_type(label, display, description, default=2, verbosity=1):
+    class Meta:
+        ordering = ["id"]
+        verbose_name = _("failed notice batch")
+        verbose_name_plural = _("failed notice batches")
+
+    def __unicode__(self):
+        return u"%s: %s" % (self.label, self.error_type)
+
+class EngineLock(models.Model):
+    """
+    A lock held by an engine run (like ``emit_notices``) when
+    NOTIFICATION_LOCK_BACKEND is "database", see notification.locks.
+    """
+    name = models.CharField(_('name'), max_length=100, primary_key=True)
+    owner = models.CharField(_('owner'), max_length=255)
+    host = models.CharField(_('host'), max_length=255)
+    pid = models.PositiveIntegerField(_('pid'))
+    acquired = models.DateTimeField(_('acquired'))
+    heartbeat = models.DateTimeField(_('heartbeat'))
+
+    class Meta:
+        verbose_name = _("engine lock")
+        verbose_name_plural = _("engine locks")
+
+    def __unicode__(self):
+        return u"%s (%s, pid %s)" % (self.name, self.host, self.pid)
+
+class IdempotencyKey(models.Model):
+    """
+    Records that the notice sent with ``key`` reached ``user``, see
+    send_now(). Rows older than NOTIFICATION_IDEMPOTENCY_WINDOW are ignored
+    and deleted by prune_notices.
+    """
+    user = models.ForeignKey(User, verbose_name=_('user'))
+    key = models.CharField(_('key'), max_length=255)
+    added = models.DateTimeField(_('added'), default=datetime.datetime.now, db_index=True)
+
+    class Meta:
+        unique_together = ("user", "key")
+        verbose_name = _("idempotency key")
+        verbose_name_plural = _("idempotency keys")
+
+class SentNotices(object):
+    """
+    The users that the notice with idempotency ``key`` was already sent to
+    within the window, looked up for all of ``users`` with one query.
+    """
+    def __init__(self, users, key):
+        self.key = key
+        self.cutoff = datetime.datetime.now() - datetime.timedelta(seconds=IDEMPOTENCY_WINDOW)
+        self.added = dict(IdempotencyKey.objects.filter(user__in=[user.pk for user in users],
+                                                        key=key).values_list("user", "added"))
+
+    def already_sent(self, user):
+        added = self.added.get(user.pk)
+        return added is not None and added >= self.cutoff
+
+    def mark_sent(self, user):
+        now = datetime.datetime.now()
+        if user.pk in self.added:
+            # the key had expired
+            IdempotencyKey.objects.filter(user=user, key=self.key).update(added=now)
+        else:
+            # a savepoint only works inside a managed transaction; outside
+            # of one the insert is committed on its own
+            managed = transaction.is_managed()
+            if managed:
+                sid = transaction.savepoint()
+            try:
+                IdempotencyKey.objects.create(user=user, key=self.key, added=now)
+                if managed:
+                    transaction.savepoint_commit(sid)
+            except IntegrityError:
+                # sent at the same time by another process
+                if managed:
+                    transaction.savepoint_rollback(sid)
+                else:
+                    transaction.rollback_unless_managed()
+        self.added[user.pk] = now
+
+def create_notice_type(label, display, description, default=2, verbosity=1, coalesce_window=0,
+                       priority=DEFAULT_PRIORITY):
     """
     Creates a new NoticeType.
 
     This is intended to be used by other apps as a post_syncdb manangement step.
     """
     try:
+        # not through the registry, which can't tell when a transaction that
+        # created the type was rolled back
         notice_type = NoticeType.objects.get(label=label)
         updated = False
         if display != notice_type.display:
@@ -220,31 +708,134 @@ def create_notice_type(label, display, description, default=2, verbosity=1):
         if default != notice_type.default:
             notice_type.default = default
             updated = True
+        if coalesce_window != notice_type.coalesce_window:
+            notice_type.coalesce_window = coalesce_window
+            updated = True
+        if priority != notice_type.priority:
+            notice_type.priority = priority
+            updated = True
         if updated:
             notice_type.save()
             if verbosity > 1:
                 print "Updated %s NoticeType" % label
     except NoticeType.DoesNotExist:
-        NoticeType(label=label, display=display, description=description, default=default).save()
+        NoticeType(label=label, display=display, description=description, default=default,
+                   coalesce_window=coalesce_window, priority=priority).save()
         if verbosity > 1:
             print "Created %s NoticeType" % label
 
+_language_model = []
+
+def get_language_model():
+    """
+    Returns the model set in NOTIFICATION_LANGUAGE_MODULE, resolving it only
+    once per process, or None if this site does not use translated
+    notifications.
+    """
+    if not _language_model:
+        model = None
+        if getattr(settings, 'NOTIFICATION_LANGUAGE_MODULE', False):
+            try:
+                app_label, model_name = settings.NOTIFICATION_LANGUAGE_MODULE.split('.')
+                model = models.get_model(app_label, model_name)
+            except (ValueError, ImportError, ImproperlyConfigured):
+                model = None
+        _language_model.append(model)
+    return _language_model[0]
+
+def _language_cache_key(user_id):
+    return 'notification_language_%s' % user_id
+
+def _language_changed(sender, instance, **kwargs):
+    if sender is get_language_model():
+        cache.delete(_language_cache_key(instance.user_id))
+
+# connected for every model when the module is imported, the language model
+# may not be loaded yet; a process that changes languages before it sends
+# anything must still invalidate the shared cache
+post_save.connect(_language_changed)
+post_delete.connect(_language_changed)
+
+def get_notification_languages(users):
+    """
+    Returns a dictionary mapping the ids of the given users to their
+    notification language, with a single query for the users whose language
+    isn't cached yet. Users without a language are left out.
+    """
+    model = get_language_model()
+    if model is None:
+        return {}
+    keys = dict([(_language_cache_key(user.id), user.id) for user in users])
+    cached = cache.get_many(keys.keys())
+    languages = dict([(keys[key], value) for key, value in cached.items()])
+    missing = [user_id for user_id in keys.values() if user_id not in languages]
+    if missing:
+        found = dict(model._default_manager.filter(user__id__in=missing).values_list('user', 'language'))
+        for user_id in missing:
+            # '' marks users without a language, the cache can't store None
+            languages[user_id] = found.get(user_id) or ''
+            cache.set(_language_cache_key(user_id), languages[user_id], LANGUAGE_CACHE_TIMEOUT)
+    return dict([(user_id, language) for user_id, language in languages.items() if language])
+
 def get_notification_language(user):
     """
     Returns site-specific notification language for this user. Raises
     LanguageStoreNotAvailable if this site does not use translated
     notifications.
     """
-    if getattr(settings, 'NOTIFICATION_LANGUAGE_MODULE', False):
-        try:
-            app_label, model_name = settings.NOTIFICATION_LANGUAGE_MODULE.split('.')
-            model = models.get_model(app_label, model_name)
-            language_model = model._default_manager.get(user__id__exact=user.id)
-            if hasattr(language_model, 'language'):
-                return language_model.language
-        except (ImportError, ImproperlyConfigured, model.DoesNotExist):
-            raise LanguageStoreNotAvailable
-    raise LanguageStoreNotAvailable
+    try:
+        return get_notification_languages([user])[user.id]
+    except KeyError:
+        raise LanguageStoreNotAvailable
+
+class SendEnvironment(object):
+    """
+    The site dependent values needed to send notices, computed once per
+    site and process. Use ``get_send_environment`` to get the current one.
+    """
+    base_formats = (
+        'short.txt',
+        'full.txt',
+        'full.html',
+    ) # TODO make formats configurable
+
+    def __init__(self, site):
+        self.site = site
+        self.domain = site.domain
+        self.base_url = u"http://%s" % unicode(site)
+        self.notices_url = self.absolute_url(reverse("notification_notice_settings"))
+        self.on_site_formats = self.base_formats
+        self.off_site_formats = self.base_formats + ('notice.html',)
+        if not LAZY_RENDERING:
+            # the rendered notice.html is what gets stored in the Notice
+            self.on_site_formats += ('notice.html',)
+
+    def absolute_url(self, path):
+        return u"%s%s" % (self.base_url, path)
+
+    def formats(self, on_site):
+        if on_site:
+            return self.on_site_formats
+        return self.off_site_formats
+
+_send_environments = {}
+
+def get_send_environment():
+    """
+    Returns the SendEnvironment for the current site.
+    """
+    site_id = settings.SITE_ID
+    try:
+        return _send_environments[site_id]
+    except KeyError:
+        environment = _send_environments[site_id] = SendEnvironment(Site.objects.get_current())
+        return environment
+
+def _site_changed(sender, instance, **kwargs):
+    _send_environments.pop(instance.pk, None)
+
+post_save.connect(_site_changed, sender=Site)
+post_delete.connect(_site_changed, sender=Site)
 
 def get_formatted_messages(formats, label, context):
     """
@@ -263,7 +854,7 @@ def get_formatted_messages(formats, label, context):
             'notification/%s' % format), context_instance=context)
     return format_templates
 
-def send_now(users, label, extra_context=None, on_site=True, context=None):
+def send_now(users, label, extra_context=None, on_site=True, context=None, idempotency_key=None):
     """
     Creates a new notice.
 
@@ -276,47 +867,86 @@ def send_now(users, label, extra_context=None, on_site=True, context=None):
     
     You can pass in on_site=False to prevent the notice emitted from being
     displayed on the site.
+
+    If the notice type has a ``coalesce_window``, a notice for a user that
+    still has an unseen notice of the same type and context from within the
+    window updates that notice (its message is re-rendered with
+    ``notice_count`` in the context) and is not delivered again.
+
+    With an ``idempotency_key`` the notice is skipped for the users it was
+    already sent to with that key within NOTIFICATION_IDEMPOTENCY_WINDOW, so
+    retrying a send is cheap. The users are looked up with one query; a
+    ``SentNotices`` instance can be passed instead of the key by callers
+    that send to the users of a batch one at a time.
+
+    Each stage is timed, see ``notification.metrics``. Inside a
+    ``notification.delivery`` pool the emails and facebook posts are sent
+    concurrently by the pool, which lists the users whose deliveries failed
+    in ``undelivered`` once waited for. With an idempotency key, those users
+    aren't recorded as sent; the others are recorded by ``wait()``.
     """
+    send_started = started = time.time()
     if extra_context is None:
         extra_context = {}
     
-    #create the ActivityContext object
+    #get or create the ActivityContext object
     if context:
-        ct = ContentType.objects.get_for_model(context)
-        m = ct.model
-        context = ActivityContext.objects.get_or_create(content_type = ct,
-                                                        object_id=context.pk)[0]
-    notice_type = NoticeType.objects.get(label=label)
+        context_id = ActivityContext.objects.get_id_for(context)
+        context_type_id = ContentType.objects.get_for_model(context).pk
+        context_object_id = context.pk
+    else:
+        context_id = context_type_id = context_object_id = None
+    notice_type = notice_types.get(label)
 
-    current_site = Site.objects.get_current()
-    
-    notices_url = u"http://%s%s" % (
-                    unicode(current_site),
-                    reverse("notification_notice_settings"))
-    
-        
-    current_language = get_language()
+    environment = get_send_environment()
+    current_site = environment.site
+    notices_url = environment.notices_url
+    formats = environment.formats(on_site)
 
-    formats = (
-        'short.txt',
-        'full.txt',        
-        'full.html',
-    ) # TODO make formats configurable
-    if not LAZY_RENDERING and on_site:
-        formats += ('notice.html',) 
+    current_language = get_language()
 
+    # get user languages from language store defined in
+    # NOTIFICATION_LANGUAGE_MODULE setting and group the users by language so
+    # each language is activated once
+    users = list(users)
+    sent_notices = None
+    if idempotency_key:
+        if isinstance(idempotency_key, SentNotices):
+            sent_notices = idempotency_key
+        else:
+            sent_notices = SentNotices(users, idempotency_key)
+        unsent = [user for user in users if not sent_notices.already_sent(user)]
+        if len(unsent) < len(users):
+            metrics.incr("duplicates", label, value=len(users) - len(unsent))
+        users = unsent
+    languages = get_notification_languages(users)
+    by_language = {}
+    for user in users:
+        by_language.setdefault(languages.get(user.id), []).append(user)
+    users = []
+    for language_users in by_language.values():
+        users.extend(language_users)
+    notice_settings = get_notification_settings(users, [notice_type])
+    delivery_pool = get_delivery_pool()
+    started = record_stage("setup", started, label)
+
+    active_language = current_language
     for user in users:
         recipients = []
-        # get user language for user from language store defined in
-        # NOTIFICATION_LANGUAGE_MODULE setting
-        try:
-            language = get_notification_language(user)
-        except LanguageStoreNotAvailable:
-            language = None
-
-        if language is not None:
+        language = languages.get(user.id) or current_language
+        if language != active_language:
             # activate the user's language
             activate(language)
+            active_language = language
+
+        coalesced = None
+        if on_site:
+            coalesced = Notice.objects.coalescable(user, notice_type, context_id)
+        if coalesced is not None:
+            notice_count = coalesced.count + 1
+        else:
+            notice_count = 1
+        started = record_stage("coalesce", started, label)
 
         # update template context with user specific translations
         template_context = Context({
@@ -324,6 +954,7 @@ def send_now(users, label, extra_context=None, on_site=True, context=None):
             "notice": ugettext(notice_type.display),
             "notices_url": notices_url,
             "current_site": current_site,
+            "notice_count": notice_count,
         })
         template_context.update(extra_context)
 
@@ -345,59 +976,115 @@ def send_now(users, label, extra_context=None, on_site=True, context=None):
             "notice": ugettext(notice_type.display),
             "notices_url": notices_url,
             "current_site": current_site,
+            "notice_count": notice_count,
             })
             ctx.update(extra_context)
-            notice = Notice.objects.create(user=user, message=pickle.dumps(ctx).encode("base64"),
-            notice_type=notice_type, on_site=on_site, context = context)
+            message = pickle.dumps(ctx).encode("base64")
         else:
-            notice = Notice.objects.create(user=user, message=messages['notice.html'],
-            notice_type=notice_type, on_site=on_site, context = context)
+            message = messages['notice.html']
+        started = record_stage("render", started, label)
+
+        if coalesced is not None:
+            Notice.objects.filter(pk=coalesced.pk).update(message=message,
+                count=models.F('count') + 1, added=datetime.datetime.now())
+            started = record_stage("store", started, label)
+            metrics.incr("coalesced", label)
+            if sent_notices is not None:
+                sent_notices.mark_sent(user)
+            continue
+
+        notice_fields = dict(user=user, message=message, notice_type=notice_type, on_site=on_site,
+            context_content_type_id=context_type_id, context_object_id=context_object_id)
+        # a savepoint only works inside a managed transaction, like the
+        # engine's; outside of one the failed insert is rolled back
+        managed = transaction.is_managed()
+        if managed:
+            sid = transaction.savepoint()
+        try:
+            notice = Notice.objects.create(context_id=context_id, **notice_fields)
+            if managed:
+                transaction.savepoint_commit(sid)
+        except IntegrityError:
+            if context_id is None:
+                raise
+            # the remembered context was deleted, maybe by another process
+            if managed:
+                transaction.savepoint_rollback(sid)
+            else:
+                transaction.rollback_unless_managed()
+            context_id = ActivityContext.objects.get_id_for(context, refresh=True)
+            notice = Notice.objects.create(context_id=context_id, **notice_fields)
+        started = record_stage("store", started, label)
         
-        if should_send(user, notice_type, "1") and user.email: # Email
+        if notice_settings[(user.id, notice_type.id, "3")].send: # Email digest
+            DigestItem.objects.create(user=user, notice=notice)
+        elif notice_settings[(user.id, notice_type.id, "1")].send and user.email: # Email
             recipients.append(user.email)
+        send_facebook = notice_settings[(user.id, notice_type.id, "2")].send and PROFILES_ACTIVATED
+        started = record_stage("preferences", started, label)
         
         #facebook
-        if should_send(user, notice_type, "2") and PROFILES_ACTIVATED:
+        if send_facebook:
             #try to guess the facebook stuff:
-            if not 'name' in extra_context:
-                extra_context['name'] = current_site.domain
-            if not 'description' in extra_context:
-                extra_context['description']= subject
-            if not 'link' in extra_context:
-                extra_context['link'] = notices_url
-            if not 'picture' in extra_context and hasattr(settings, 'NOTIFICATION_SITE_PICTURE'):
-                extra_context['picture'] = settings.NOTIFICATION_SITE_PICTURE
-            send_to_facebook(user, extra_context)
+            facebook_context = dict(extra_context)
+            if not 'name' in facebook_context:
+                facebook_context['name'] = current_site.domain
+            if not 'description' in facebook_context:
+                facebook_context['description']= subject
+            if not 'link' in facebook_context:
+                facebook_context['link'] = notices_url
+            if not 'picture' in facebook_context and hasattr(settings, 'NOTIFICATION_SITE_PICTURE'):
+                facebook_context['picture'] = settings.NOTIFICATION_SITE_PICTURE
+            if delivery_pool is not None:
+                delivery_pool.submit("2", label, post_to_facebook, user, facebook_context)
+            else:
+                send_to_facebook(user, facebook_context)
+                started = record_stage("deliver", started, label, "2")
             
-        send_mail(subject, body, settings.DEFAULT_FROM_EMAIL, recipients)
+        if delivery_pool is not None:
+            if recipients:
+                delivery_pool.submit("1", label, send_mail, subject, body,
+                                     settings.DEFAULT_FROM_EMAIL, recipients)
+            mark_sent = None
+            if sent_notices is not None:
+                # only once the pool has delivered everything to the user
+                mark_sent = lambda user=user: sent_notices.mark_sent(user)
+            delivery_pool.finish(user, mark_sent)
+        else:
+            send_mail(subject, body, settings.DEFAULT_FROM_EMAIL, recipients)
+            if recipients:
+                started = record_stage("deliver", started, label, "1")
+            if sent_notices is not None:
+                sent_notices.mark_sent(user)
+        metrics.incr("sent", label)
 
     # reset environment to original language
     activate(current_language)
+    record_stage("send_now", send_started, label)
 
-@daemonize
-def send_to_facebook(user, context={}):
+def post_to_facebook(user, context={}):
     """Send a wall post to a user's facebook profile
-    
-      It's run as a daemon, to avoid delaying too much the response time of the original response
     """
     
     #only leave the facebook attrs:
     facebook_attrs = ['name', 'link', 'caption', 'description', 'picture']
-    for e in context.keys():
-        if e not in facebook_attrs:
-            del context[e]  
+    context = dict([(key, value) for key, value in context.items() if key in facebook_attrs])
     
     #description="", picture="", link="http://escolarea.com", message="", caption="" 
     if "http://" not in context.get('link', ''):
         #build the full url        
-        context['link'] = u"http://%s%s" % (
-                    unicode(Site.objects.get_current()), context.get('link', ''))
+        context['link'] = get_send_environment().absolute_url(context.get('link', ''))
         
     access_token = getattr(user.get_profile(), FACEBOOK_ATTR, None)
     if context and access_token:
+        started = time.time()
         graph_api = GraphAPI(access_token)
         graph_api.put_wall_post(message=context.get('message', ''),
                                 attachment=context)
+        record_stage("facebook_post", started, medium="2")
+
+# run as a daemon, to avoid delaying too much the response time of the original response
+send_to_facebook = daemonize(post_to_facebook)
 
 
 def send(*args, **kwargs):
@@ -406,26 +1093,56 @@ def send(*args, **kwargs):
     flag NOTIFICATION_QUEUE_ALL that helps determine whether all calls should
     be queued or not. A per call ``queue`` or ``now`` keyword argument can be
     used to always override the default global behavior.
+
+    Arguments that only apply to ``queue`` (like ``priority``) are dropped
+    when the notice is sent right away. Notices with a ``send_at`` time are
+    always queued.
     """
     queue_flag = kwargs.pop("queue", False)
     now_flag = kwargs.pop("now", False)
     assert not (queue_flag and now_flag), "'queue' and 'now' cannot both be True."
+    queue_kwargs = {}
+    for name in QUEUE_ONLY_ARGUMENTS:
+        if name in kwargs:
+            queue_kwargs[name] = kwargs.pop(name)
+    if not now_flag and getattr(_auto_notify_state, "force_queue", False):
+        queue_flag = True
+    if queue_kwargs.get("send_at") is not None:
+        assert not now_flag, "'now' and 'send_at' cannot be used together."
+        queue_flag = True
     if queue_flag:
+        kwargs.update(queue_kwargs)
         return queue(*args, **kwargs)
     elif now_flag:
         return send_now(*args, **kwargs)
     else:
         if QUEUE_ALL:
+            kwargs.update(queue_kwargs)
             return queue(*args, **kwargs)
         else:
             return send_now(*args, **kwargs)
+
+QUEUE_ONLY_ARGUMENTS = ("priority", "send_at", "key")
         
-def queue(users, label, extra_context=None, on_site=True, context = None):
+def queue(users, label, extra_context=None, on_site=True, context = None, priority=None,
+          send_at=None, key="", idempotency_key=None):
     """
     Queue the notification in NoticeQueueBatch. This allows for large amounts
     of user notifications to be deferred to a seperate process running outside
     the webserver.
+
+    ``priority`` defaults to the priority of the notice type; batches with a
+    lower priority are sent first.
+
+    ``send_at`` is a datetime (in the server's time zone) or a timedelta from
+    now; the notices aren't sent before then. To send at a given local time,
+    queue the users of each time zone separately. ``key`` names the batch
+    for cancel_queued(). The ``idempotency_key`` is passed on to send_now().
     """
+    if priority is None:
+        priority = notice_types.get(label).priority
+    if isinstance(send_at, datetime.timedelta):
+        send_at = datetime.datetime.now() + send_at
     if extra_context is None:
         extra_context = {}
     if isinstance(users, QuerySet):
@@ -435,7 +1152,39 @@ def queue(users, label, extra_context=None, on_site=True, context = None):
     notices = []
     for user in users:
         notices.append((user, label, extra_context, on_site, context))
-    NoticeQueueBatch(pickled_data=pickle.dumps(notices).encode("base64")).save()
+    NoticeQueueBatch(pickled_data=pickle.dumps(notices).encode("base64"), priority=priority,
+                     send_at=send_at, key=key or "", idempotency_key=idempotency_key or "").save()
+    if send_at is None:
+        wake_up_emitter()
+
+def cancel_queued(key):
+    """
+    Deletes the queued batches with the given ``key`` that haven't been sent
+    yet and returns how many there were.
+    """
+    batches = NoticeQueueBatch.objects.filter(key=key)
+    count = batches.count()
+    if count:
+        batches.delete()
+    return count
+
+def wake_up_emitter():
+    """
+    Tells a running ``emit_notices --daemon`` that there is work to do,
+    through the NOTIFICATION_WAKEUP_SOCKET. Does nothing if it isn't set or
+    nobody is listening.
+    """
+    if not WAKEUP_SOCKET:
+        return
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.setblocking(0)
+            sock.sendto("1", WAKEUP_SOCKET)
+        finally:
+            sock.close()
+    except socket.error:
+        pass
 
 class ObservedItemManager(models.Manager):
 
@@ -453,6 +1202,27 @@ class ObservedItemManager(models.Manager):
         observed_item = self.get(content_type=content_type, object_id=observed.id, user=observer, signal=signal)
         return observed_item
 
+    def observing_map(self, objects, observer, signal):
+        """
+        Returns a dictionary mapping each of the given objects to whether
+        ``observer`` is observing it, using a single query for the whole list.
+        """
+        objects = list(objects)
+        result = dict([(obj, False) for obj in objects])
+        if not objects:
+            return result
+        by_type = {}
+        for obj in objects:
+            content_type = ContentType.objects.get_for_model(obj)
+            by_type.setdefault(content_type.pk, {})[obj.pk] = obj
+        lookup = Q()
+        for content_type_id, objs in by_type.items():
+            lookup |= Q(content_type=content_type_id, object_id__in=objs.keys())
+        observed = self.filter(lookup, user=observer, signal=signal).values_list('content_type', 'object_id')
+        for content_type_id, object_id in observed:
+            result[by_type[content_type_id][object_id]] = True
+        return result
+
 
 class ObservedItem(models.Model):
 
@@ -466,8 +1236,10 @@ class ObservedItem(models.Model):
 
     added = models.DateTimeField(_('added'), default=datetime.datetime.now)
 
-    # the signal that will be listened to send the notice
-    signal = models.TextField(verbose_name=_('signal'))
+    # the signal that will be listened to send the notice. Lookups on
+    # (content_type, object_id, signal, user) are covered by the index in
+    # sql/observeditem.sql
+    signal = models.CharField(verbose_name=_('signal'), max_length=255)
 
     objects = ObservedItemManager()
 
@@ -477,7 +1249,7 @@ class ObservedItem(models.Model):
         verbose_name_plural = _('observed items')
 
     def send_notice(self):
-        send([self.user], self.notice_type.label,
+        send([self.user], notice_types.get_by_id(self.notice_type_id).label,
              {'observed': self.observed_object})
 
 
@@ -487,7 +1259,7 @@ def observe(observed, observer, notice_type_label, signal='post_save'):
 
     To be used by applications to register a user as an observer for some object.
     """
-    notice_type = NoticeType.objects.get(label=notice_type_label)
+    notice_type = notice_types.get(notice_type_label)
     observed_item = ObservedItem(user=observer, observed_object=observed,
                                  notice_type=notice_type, signal=signal)
     observed_item.save()
@@ -503,10 +1275,17 @@ def stop_observing(observed, observer, signal='post_save'):
 def send_observation_notices_for(observed, signal='post_save'):
     """
     Send a notice for each registered user about an observed object.
+
+    Observers are grouped by notice type so that a single ``send`` call (and a
+    single queue batch) is issued per notice type instead of one per observer.
     """
-    observed_items = ObservedItem.objects.all_for(observed, signal)
+    observed_items = ObservedItem.objects.all_for(observed, signal).select_related('user')
+    groups = {}
     for observed_item in observed_items:
-        observed_item.send_notice()
+        notice_type = notice_types.get_by_id(observed_item.notice_type_id)
+        groups.setdefault(notice_type.label, []).append(observed_item.user)
+    for label, users in groups.items():
+        send(users, label, {'observed': observed})
     return observed_items
 
 def is_observing(observed, observer, signal='post_save'):
@@ -520,12 +1299,91 @@ def is_observing(observed, observer, signal='post_save'):
     except ObservedItem.MultipleObjectsReturned:
         return True
 
+def observing_map(observer, objects, signal='post_save'):
+    """
+    Like ``is_observing`` but for a whole list of objects at once. Returns a
+    dictionary mapping each object to True or False.
+    """
+    if isinstance(observer, AnonymousUser):
+        return dict([(obj, False) for obj in objects])
+    return ObservedItem.objects.observing_map(objects, observer, signal)
+
 def handle_observations(sender, instance, *args, **kw):
     send_observation_notices_for(instance)
 
 
 #alternative for observations
-from django.db.models.signals import post_save
+from django.core.signals import request_started, request_finished, got_request_exception
+
+class DeferredAutoNotify(object):
+    """
+    post_save receiver for an AUTO_NOTIFY entry.
+
+    Instead of running the callback while the instance is being saved, the
+    save is recorded and the callback runs once per instance when
+    ``flush_auto_notify`` is called (at the end of the request, after the
+    transaction middleware committed). Repeated saves of the same instance
+    are merged into a single call. Outside of a request nothing would flush
+    the saves, so the callback runs right away.
+    """
+    def __init__(self, callback):
+        self.callback = callback
+
+    def __call__(self, sender, instance, created=False, **kwargs):
+        if not getattr(_auto_notify_state, "in_request", False):
+            self.callback(sender=sender, instance=instance, created=created, **kwargs)
+            return
+        pending = getattr(_auto_notify_state, "pending", None)
+        if pending is None:
+            pending = _auto_notify_state.pending = {}
+            _auto_notify_state.order = []
+        key = (self.callback, sender, instance.pk)
+        if key in pending:
+            created = created or pending[key][1]
+        else:
+            _auto_notify_state.order.append(key)
+        pending[key] = (instance, created)
+
+def flush_auto_notify(**kwargs):
+    """
+    Runs the AUTO_NOTIFY callbacks recorded in this thread.
+
+    Called when the request finishes. Calls to ``send`` made by the callbacks
+    are queued when ``NOTIFICATION_AUTO_NOTIFY_QUEUE`` is True.
+    """
+    pending = getattr(_auto_notify_state, "pending", None)
+    if not pending:
+        return
+    order = _auto_notify_state.order
+    discard_auto_notify()
+    _auto_notify_state.force_queue = AUTO_NOTIFY_QUEUE
+    try:
+        for key in order:
+            callback, sender, pk = key
+            instance, created = pending[key]
+            callback(sender=sender, instance=instance, created=created, signal=post_save)
+    finally:
+        _auto_notify_state.force_queue = False
+
+def discard_auto_notify(**kwargs):
+    """
+    Forgets the AUTO_NOTIFY callbacks recorded in this thread, e.g. because
+    the request failed and its transaction was rolled back.
+    """
+    _auto_notify_state.pending = None
+    _auto_notify_state.order = []
+
+def _request_started(**kwargs):
+    _auto_notify_state.in_request = True
+
+def _request_finished(**kwargs):
+    # saves made by the callbacks run their own callbacks right away
+    _auto_notify_state.in_request = False
+    flush_auto_notify()
+
+request_started.connect(_request_started)
+request_finished.connect(_request_finished)
+got_request_exception.connect(discard_auto_notify)
 
 for model_path, callback_path in settings.AUTO_NOTIFY:
     #get model module
@@ -539,4 +1397,7 @@ for model_path, callback_path in settings.AUTO_NOTIFY:
     callback_module = __import__(callback_module_name, globals(), locals(), [callback_name])
     callback = getattr(callback_module, callback_name)
     
-    post_save.connect(callback, sender=model_class)    
+    if DEFER_AUTO_NOTIFY:
+        post_save.connect(DeferredAutoNotify(callback), sender=model_class, weak=False)
+    else:
+        post_save.connect(callback, sender=model_class)
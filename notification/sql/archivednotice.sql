@@ -0,0 +1 @@
+CREATE INDEX notification_archivednotice_context ON notification_archivednotice (user_id, context_content_type_id, context_object_id, added);
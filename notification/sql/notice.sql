@@ -0,0 +1 @@
+CREATE INDEX notification_notice_context ON notification_notice (user_id, context_content_type_id, context_object_id, added);
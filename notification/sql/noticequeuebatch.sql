@@ -0,0 +1 @@
+CREATE INDEX notification_noticequeuebatch_lane ON notification_noticequeuebatch (priority, id);
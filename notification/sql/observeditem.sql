@@ -0,0 +1 @@
+CREATE INDEX notification_observeditem_lookup ON notification_observeditem (content_type_id, object_id, signal, user_id);
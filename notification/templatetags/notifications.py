@@ -1,6 +1,6 @@
 from django import template
 register = template.Library()
-from notification.models import Notice
+from notification.models import Notice, observing_map
 
 @register.filter
 def unread_notifications(user, context):
@@ -8,4 +8,36 @@ def unread_notifications(user, context):
     if context:
         return Notice.objects.unseen_count_for(user, context=context)
     else:
-        return Notice.objects.unseen_count_for(user)
\ No newline at end of file
+        return Notice.objects.unseen_count_for(user)
+
+class ObservingMapNode(template.Node):
+    def __init__(self, objects, observer, var_name):
+        self.objects = template.Variable(objects)
+        self.observer = template.Variable(observer)
+        self.var_name = var_name
+
+    def render(self, context):
+        objects = self.objects.resolve(context)
+        observer = self.observer.resolve(context)
+        context[self.var_name] = observing_map(observer, objects)
+        return ''
+
+@register.tag
+def get_observing_map(parser, token):
+    """
+    Finds out in one query which of the objects in a list are observed by a
+    user::
+
+        {% get_observing_map object_list for user as watching %}
+        {% for object in object_list %}
+            {% if watching|observing:object %}...{% endif %}
+        {% endfor %}
+    """
+    bits = token.split_contents()
+    if len(bits) != 6 or bits[2] != 'for' or bits[4] != 'as':
+        raise template.TemplateSyntaxError("%r tag syntax is: {%% %s objects for user as var %%}" % (bits[0], bits[0]))
+    return ObservingMapNode(bits[1], bits[3], bits[5])
+
+@register.filter
+def observing(observing_map, obj):
+    return observing_map.get(obj, False)
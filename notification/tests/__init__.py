@@ -0,0 +1,9 @@
+from notification.tests.query_budgets import *
+from notification.tests.delivery import *
+from notification.tests.engine import *
+from notification.tests.locks import *
+from notification.tests.auto_notify import *
+from notification.tests.coalescing import *
+from notification.tests.registry import *
+from notification.tests.contexts import *
+from notification.tests.archive import *
@@ -0,0 +1,113 @@
+"""
+The ArchivedNotice table: moving notices into it, finding them again from
+the views and paging through both tables merged.
+"""
+import os
+import datetime
+
+from django.conf import settings
+from django.test import TestCase
+from django.contrib.auth.models import User
+
+from notification import models as notification
+from notification import engine
+from notification.models import Notice, ArchivedNotice, CombinedNotices
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), "templates")
+
+
+class ArchiveTest(TestCase):
+    urls = "notification.tests.urls"
+
+    def setUp(self):
+        self._old_template_dirs = settings.TEMPLATE_DIRS
+        settings.TEMPLATE_DIRS = (TEMPLATE_DIR,) + tuple(settings.TEMPLATE_DIRS)
+        self._old_send_to_facebook = notification.send_to_facebook
+        notification.send_to_facebook = lambda user, context={}: None
+        notification.notice_types.clear()
+        notification.create_notice_type("archivable", "Archivable", "archivable notice")
+        self.owner = User.objects.create_user("owner", "owner@example.com", "secret")
+        self.other = User.objects.create_user("other", "other@example.com", "secret")
+
+    def tearDown(self):
+        settings.TEMPLATE_DIRS = self._old_template_dirs
+        notification.send_to_facebook = self._old_send_to_facebook
+
+    def archive_one(self):
+        """
+        Archives a notice of ``owner`` and sends one to ``other`` that gets
+        the id it had, which the database reuses once the table is empty.
+        """
+        notification.send_now([self.owner], "archivable")
+        notice = Notice.objects.get(user=self.owner)
+        notice.archive()
+        self.assertEqual(engine.archive_notices(max_age=None), 1)
+        notification.send_now([self.other], "archivable")
+        reused = Notice.objects.get(user=self.other)
+        self.assertEqual(reused.pk, notice.pk)
+        return ArchivedNotice.objects.get(original_id=notice.pk), reused
+
+    def test_archiving_a_reused_id(self):
+        archived, reused = self.archive_one()
+        reused.archive()
+        self.assertEqual(engine.archive_notices(max_age=None), 1)
+        self.assertEqual(sorted(ArchivedNotice.objects.values_list("original_id", "user__username")),
+                         [(reused.pk, "other"), (reused.pk, "owner")])
+
+    def test_single(self):
+        archived, reused = self.archive_one()
+        self.client.login(username="owner", password="secret")
+        response = self.client.get("/notices/%s/" % reused.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["notice"], archived)
+        response = self.client.get(archived.get_absolute_url())
+        self.assertEqual(response.context["notice"], archived)
+        self.client.login(username="other", password="secret")
+        response = self.client.get("/notices/%s/" % reused.pk)
+        self.assertEqual(response.context["notice"], reused)
+        self.assertEqual(self.client.get(archived.get_absolute_url()).status_code, 404)
+
+    def test_archive_and_delete(self):
+        archived, reused = self.archive_one()
+        self.client.login(username="owner", password="secret")
+        # the owner's id now names the archived notice, which stays put
+        self.client.get("/archive/%s/" % reused.pk)
+        self.assertFalse(Notice.objects.get(pk=reused.pk).archived)
+        self.assertTrue(ArchivedNotice.objects.filter(pk=archived.pk).exists())
+        self.client.get("/delete/%s/" % reused.pk)
+        self.assertFalse(ArchivedNotice.objects.filter(pk=archived.pk).exists())
+        self.assertTrue(Notice.objects.filter(pk=reused.pk).exists())
+
+        notification.send_now([self.owner], "archivable")
+        notice = Notice.objects.get(user=self.owner)
+        notice.archive()
+        engine.archive_notices(max_age=None)
+        archived = ArchivedNotice.objects.get(user=self.owner)
+        self.client.login(username="other", password="secret")
+        self.client.get("/archived/delete/%s/" % archived.pk)
+        self.assertTrue(ArchivedNotice.objects.filter(pk=archived.pk).exists())
+        self.client.login(username="owner", password="secret")
+        self.client.get("/archived/delete/%s/" % archived.pk)
+        self.assertFalse(ArchivedNotice.objects.filter(pk=archived.pk).exists())
+
+    def test_combined_slices(self):
+        base = datetime.datetime(2010, 1, 1)
+        # ties in ``added`` within and across the tables
+        for i in range(14):
+            notification.send_now([self.owner], "archivable")
+        for i, notice in enumerate(Notice.objects.order_by("pk")):
+            notice.added = base + datetime.timedelta(hours=i // 3)
+            notice.archived = (i % 3 != 1)
+            notice.save()
+        engine.archive_notices(max_age=None)
+        combined = Notice.objects.notices_for(self.owner, archived=True)
+        self.assertTrue(isinstance(combined, CombinedNotices))
+        expected = [(notice.added, 0, notice.pk) for notice in Notice.objects.filter(user=self.owner)]
+        expected += [(notice.added, -1, notice.pk) for notice in ArchivedNotice.objects.filter(user=self.owner)]
+        expected = [(added, rank) for added, rank, pk in sorted(expected, reverse=True)]
+        self.assertEqual(combined.count(), 14)
+        for start in range(15):
+            for stop in range(start, 16):
+                page = [(notice.added, isinstance(notice, ArchivedNotice) and -1 or 0)
+                        for notice in combined[start:stop]]
+                self.assertEqual(page, expected[start:stop])
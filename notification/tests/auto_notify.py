@@ -0,0 +1,52 @@
+"""
+Deferred AUTO_NOTIFY callbacks, inside and outside of a request.
+"""
+from django.test import TestCase
+from django.db.models.signals import post_save
+from django.core.signals import request_started, request_finished, got_request_exception
+from django.contrib.auth.models import Group
+
+from notification import models as notification
+
+
+class DeferredAutoNotifyTest(TestCase):
+
+    def setUp(self):
+        self.calls = []
+        def callback(sender, instance, created=False, **kwargs):
+            self.calls.append((instance.pk, created))
+        self.receiver = notification.DeferredAutoNotify(callback)
+        post_save.connect(self.receiver, sender=Group, weak=False)
+
+    def tearDown(self):
+        post_save.disconnect(self.receiver, sender=Group)
+        notification.discard_auto_notify()
+        notification._auto_notify_state.in_request = False
+
+    def test_off_by_default(self):
+        self.failIf(notification.DEFER_AUTO_NOTIFY)
+
+    def test_outside_of_a_request(self):
+        group = Group.objects.create(name="outside")
+        group.save()
+        self.assertEqual(self.calls, [(group.pk, True), (group.pk, False)])
+        self.failIf(getattr(notification._auto_notify_state, "pending", None))
+
+    def test_inside_a_request(self):
+        request_started.send(sender=self.__class__)
+        group = Group.objects.create(name="inside")
+        group.save()
+        self.assertEqual(self.calls, [])
+        request_finished.send(sender=self.__class__)
+        self.assertEqual(self.calls, [(group.pk, True)])
+        self.failIf(notification._auto_notify_state.pending)
+        # back outside of a request
+        group.save()
+        self.assertEqual(self.calls, [(group.pk, True), (group.pk, False)])
+
+    def test_failed_request(self):
+        request_started.send(sender=self.__class__)
+        Group.objects.create(name="failed")
+        got_request_exception.send(sender=self.__class__, request=None)
+        request_finished.send(sender=self.__class__)
+        self.assertEqual(self.calls, [])
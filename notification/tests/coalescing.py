@@ -0,0 +1,32 @@
+"""
+Coalescing bursts of notices of the same type.
+"""
+from django.test import TestCase
+from django.contrib.auth.models import User
+
+from notification import models as notification
+from notification.models import Notice
+
+
+class CoalescingTest(TestCase):
+
+    def setUp(self):
+        self._old_send_to_facebook = notification.send_to_facebook
+        notification.send_to_facebook = lambda user, context={}: None
+        notification.create_notice_type("burst", "Burst", "burst notice", coalesce_window=3600)
+        self.user = User.objects.create_user("bursty", "bursty@example.com", "secret")
+
+    def tearDown(self):
+        notification.send_to_facebook = self._old_send_to_facebook
+
+    def test_merges_unseen_notices(self):
+        notification.send_now([self.user], "burst")
+        notification.send_now([self.user], "burst")
+        notice = Notice.objects.get(user=self.user)
+        self.assertEqual(notice.count, 2)
+
+    def test_not_into_off_site_notices(self):
+        notification.send_now([self.user], "burst", on_site=False)
+        notification.send_now([self.user], "burst")
+        self.assertEqual(sorted(Notice.objects.filter(user=self.user).values_list("on_site", "count")),
+                         [(False, 1), (True, 1)])
@@ -0,0 +1,60 @@
+"""
+The per-process cache of ActivityContext ids.
+"""
+from django.db import IntegrityError
+from django.test import TestCase
+from django.contrib.auth.models import User, Group
+from django.contrib.contenttypes.models import ContentType
+
+from notification import models as notification
+from notification.models import Notice, ActivityContext
+
+
+class ActivityContextCacheTest(TestCase):
+
+    def setUp(self):
+        notification._activity_context_ids.clear()
+        self._old_send_to_facebook = notification.send_to_facebook
+        notification.send_to_facebook = lambda user, context={}: None
+        notification.create_notice_type("context", "Context", "context notice")
+        self.user = User.objects.create_user("contextual", "contextual@example.com", "secret")
+        self.group = Group.objects.create(name="context")
+        self.key = (ContentType.objects.get_for_model(Group).pk, self.group.pk)
+
+    def tearDown(self):
+        notification.send_to_facebook = self._old_send_to_facebook
+        notification._activity_context_ids.clear()
+        if "create" in Notice.objects.__dict__:
+            del Notice.objects.create
+
+    def test_uncommitted_ids_are_not_remembered(self):
+        # the test case runs in a transaction with uncommitted changes
+        context_id = ActivityContext.objects.get_id_for(self.group)
+        self.assertEqual(ActivityContext.objects.get(pk=context_id).object_id, self.group.pk)
+        self.failUnless(notification._activity_context_ids.get(self.key) is None)
+
+    def test_deleted_here(self):
+        notification._activity_context_ids.set(self.key, ActivityContext.objects.get_id_for(self.group))
+        ActivityContext.objects.all().delete()
+        self.failUnless(notification._activity_context_ids.get(self.key) is None)
+
+    def test_refresh(self):
+        notification._activity_context_ids.set(self.key, 999999)
+        self.assertEqual(ActivityContext.objects.get_id_for(self.group), 999999)
+        context_id = ActivityContext.objects.get_id_for(self.group, refresh=True)
+        self.assertNotEqual(context_id, 999999)
+        self.assertEqual(ActivityContext.objects.get(pk=context_id).object_id, self.group.pk)
+
+    def test_send_now_rechecks_deleted_context(self):
+        # deleted by another process, whose delete we don't hear about
+        notification._activity_context_ids.set(self.key, 999999)
+        create = Notice.objects.create
+        def create_checking_fk(**kwargs):
+            # sqlite doesn't check foreign keys
+            if not ActivityContext.objects.filter(pk=kwargs["context_id"]).exists():
+                raise IntegrityError("no such context")
+            return create(**kwargs)
+        Notice.objects.create = create_checking_fk
+        notification.send_now([self.user], "context", context=self.group)
+        notice = Notice.objects.get(user=self.user)
+        self.assertEqual(notice.context.object_id, self.group.pk)
@@ -0,0 +1,193 @@
+"""
+Concurrent delivery against the local SMTP and Graph API stubs.
+"""
+import time
+import socket
+import pickle
+
+from django.conf import settings
+from django.test import TestCase
+from django.contrib.auth.models import User
+
+from notification import models as notification
+from notification import delivery
+from notification import engine
+from notification.models import NoticeQueueBatch, IdempotencyKey
+from notification.facebook import GraphAPI
+from notification.tests.stubs import StubSMTPServer, StubGraphServer
+
+# seconds each stub takes to answer
+DELAY = 0.2
+
+
+class DeliveryPoolTest(TestCase):
+
+    def setUp(self):
+        self.smtp = StubSMTPServer(delay=DELAY)
+        self.smtp.start()
+        self.graph = StubGraphServer(delay=DELAY)
+        self.graph.start()
+        self._old_email_settings = (settings.EMAIL_BACKEND, settings.EMAIL_HOST, settings.EMAIL_PORT)
+        settings.EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
+        settings.EMAIL_HOST, settings.EMAIL_PORT = "127.0.0.1", self.smtp.port
+        self._old_graph_url = GraphAPI.graph_url
+        GraphAPI.graph_url = self.graph.url
+        notification.create_notice_type("delivery", "Delivery", "delivery test", default=2)
+
+    def tearDown(self):
+        delivery.deactivate()
+        settings.EMAIL_BACKEND, settings.EMAIL_HOST, settings.EMAIL_PORT = self._old_email_settings
+        GraphAPI.graph_url = self._old_graph_url
+        self.smtp.stop()
+        self.graph.stop()
+
+    def add_users(self, count):
+        return [User.objects.create_user("delivery%d" % i, "delivery%d@example.com" % i, "secret")
+                for i in range(count)]
+
+    def send_now(self, users, pool, idempotency_key=None):
+        started = time.time()
+        delivery.activate(pool)
+        try:
+            notification.send_now(users, "delivery", idempotency_key=idempotency_key)
+        finally:
+            delivery.deactivate()
+            stats = pool.wait()
+        return stats, time.time() - started
+
+    def test_emails_are_sent_concurrently(self):
+        users = self.add_users(10)
+        stats, seconds = self.send_now(users, delivery.DeliveryPool(max_in_flight=10))
+        self.assertEqual(stats["delivered"], {"1": 10})
+        self.assertEqual(len(self.smtp.messages), 10)
+        self.assertEqual(sorted([recipients for sender, recipients, data in self.smtp.messages]),
+                         sorted([["<%s>" % user.email] for user in users]))
+        # one after another they would take 10 * DELAY
+        self.failUnless(seconds < 5 * DELAY, "10 emails took %.2fs" % seconds)
+
+    def test_in_flight_limit(self):
+        users = self.add_users(6)
+        stats, seconds = self.send_now(users, delivery.DeliveryPool(max_in_flight=2))
+        self.assertEqual(stats["delivered"], {"1": 6})
+        # three rounds of two
+        self.failUnless(seconds >= 3 * DELAY, "6 emails, 2 at a time, took %.2fs" % seconds)
+
+    def test_facebook_posts(self):
+        pool = delivery.DeliveryPool(max_in_flight=10)
+        for i in range(10):
+            pool.submit("2", "delivery", GraphAPI("token").put_wall_post, "", {"name": "post %d" % i})
+        self.assertEqual(pool.wait()["delivered"], {"2": 10})
+        self.assertEqual(len(self.graph.posts), 10)
+        path, body = self.graph.posts[0]
+        self.failUnless(path.startswith("/me/feed"))
+        self.failUnless("access_token=token" in body)
+
+    def test_timeout(self):
+        self.graph.delay = 2
+        pool = delivery.DeliveryPool(max_in_flight=10, timeouts={"2": DELAY})
+        started = time.time()
+        pool.submit("2", "delivery", GraphAPI("token").put_wall_post, "", {"name": "slow"})
+        stats = pool.wait()
+        self.assertEqual(stats["timed_out"], {"2": 1})
+        self.failUnless(time.time() - started < 1)
+
+    def refuse_emails(self):
+        # nothing listens on a port that was just released
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        settings.EMAIL_PORT = sock.getsockname()[1]
+        sock.close()
+
+    def test_failures_are_counted(self):
+        self.refuse_emails()
+        users = self.add_users(2)
+        pool = delivery.DeliveryPool()
+        stats, seconds = self.send_now(users, pool)
+        self.assertEqual(stats["failed"].get("1"), 2)
+        self.assertEqual(sorted([user.pk for user in pool.undelivered]), sorted([user.pk for user in users]))
+
+    def test_idempotency_keys_wait_for_delivery(self):
+        users = self.add_users(2)
+        pool = delivery.DeliveryPool()
+        delivery.activate(pool)
+        try:
+            notification.send_now(users, "delivery", idempotency_key="pooled")
+        finally:
+            delivery.deactivate()
+        # recorded by wait(), after the emails went out
+        self.assertEqual(IdempotencyKey.objects.filter(key="pooled").count(), 0)
+        pool.wait()
+        self.assertEqual(IdempotencyKey.objects.filter(key="pooled").count(), 2)
+
+    def test_undelivered_are_not_marked_sent(self):
+        self.refuse_emails()
+        users = self.add_users(2)
+        self.send_now(users, delivery.DeliveryPool(), idempotency_key="refused")
+        self.assertEqual(IdempotencyKey.objects.filter(key="refused").count(), 0)
+
+    def test_finish(self):
+        pool = delivery.DeliveryPool(timeouts={"2": DELAY})
+        self.graph.delay = 2
+        done = []
+        pool.submit("1", "delivery", lambda: None)
+        pool.finish("ok", lambda: done.append("ok"))
+        pool.submit("1", "delivery", lambda: None)
+        pool.submit("2", "delivery", GraphAPI("token").put_wall_post, "", {"name": "slow"})
+        pool.finish("timed out", lambda: done.append("timed out"))
+        pool.submit("1", "delivery", lambda: 1 / 0)
+        pool.finish("failed", lambda: done.append("failed"))
+        pool.finish("nothing to deliver", lambda: done.append("nothing to deliver"))
+        pool.wait()
+        self.assertEqual(done, ["ok", "nothing to deliver"])
+        self.assertEqual(pool.undelivered, ["timed out", "failed"])
+
+    def test_timed_out_threads_count(self):
+        self.graph.delay = 1
+        pool = delivery.DeliveryPool(max_in_flight=2, timeouts={"2": DELAY}, max_threads=2)
+        started = time.time()
+        for i in range(3):
+            pool.submit("2", "delivery", GraphAPI("token").put_wall_post, "", {"name": "slow %d" % i})
+        # the first two timed out, but the third waited for one of their
+        # threads to end
+        self.failUnless(time.time() - started >= 1, "the third thread started after %.2fs" % (
+            time.time() - started))
+        pool.wait()
+
+    def test_send_all_retries_undelivered(self):
+        self.refuse_emails()
+        users = self.add_users(3)
+        notification.queue(users, "delivery")
+        summary = engine.send_all(delivery_threads=2)
+        self.assertEqual(summary["batches"], 0)
+        self.assertEqual(summary["failures"][0]["attempts"], 1)
+        batch = NoticeQueueBatch.objects.get()
+        notices = pickle.loads(str(batch.pickled_data).decode("base64"))
+        self.assertEqual(sorted([notice[0] for notice in notices]), sorted([user.pk for user in users]))
+        self.failIf(batch.send_at is None)
+        self.assertEqual(notification.Notice.objects.count(), 3)
+        # the emails get through on the retry, their notices aren't stored again
+        settings.EMAIL_PORT = self.smtp.port
+        NoticeQueueBatch.objects.update(send_at=None)
+        summary = engine.send_all(delivery_threads=2)
+        self.assertEqual((summary["batches"], summary["failures"]), (1, []))
+        self.assertEqual(NoticeQueueBatch.objects.count(), 0)
+        self.assertEqual(notification.Notice.objects.count(), 3)
+        self.assertEqual(len(self.smtp.messages), 3)
+
+    def test_retry_without_pool(self):
+        self.refuse_emails()
+        users = self.add_users(2)
+        notification.queue(users, "delivery", idempotency_key="redelivered")
+        engine.send_all(delivery_threads=2)
+        settings.EMAIL_PORT = self.smtp.port
+        NoticeQueueBatch.objects.update(send_at=None)
+        summary = engine.send_all()
+        self.assertEqual((summary["batches"], summary["failures"]), (1, []))
+        self.assertEqual(notification.Notice.objects.count(), 2)
+        self.assertEqual(len(self.smtp.messages), 2)
+        self.assertEqual(IdempotencyKey.objects.filter(key="redelivered").count(), 2)
+
+    def test_without_pool(self):
+        users = self.add_users(2)
+        notification.send_now(users, "delivery")
+        self.assertEqual(len(self.smtp.messages), 2)
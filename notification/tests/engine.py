@@ -0,0 +1,190 @@
+"""
+Retries, dead-lettering and replaying of failed queued batches, and
+idempotency keys.
+"""
+import pickle
+import datetime
+
+from django.test import TestCase, TransactionTestCase
+from django.contrib.auth.models import User
+
+from notification import models as notification
+from notification import engine
+from notification.models import NoticeQueueBatch, FailedNoticeBatch, IdempotencyKey, SentNotices
+
+
+class Boom(Exception):
+    pass
+
+
+class FailedBatchTest(TestCase):
+
+    def setUp(self):
+        self._old_send_now = notification.send_now
+        self._old_send_to_facebook = notification.send_to_facebook
+        notification.send_to_facebook = lambda user, context={}: None
+        notification.create_notice_type("failing", "Failing", "failing notice")
+        self.users = [User.objects.create_user("failing%d" % i, "failing%d@example.com" % i, "secret")
+                      for i in range(3)]
+        # the users send_now raises for, and the exception it raises
+        self.failing = set()
+        self.error = Boom
+        def send_now(users, *args, **kwargs):
+            for user in users:
+                if user.pk in self.failing:
+                    raise self.error("can't send to %s" % user)
+            return self._old_send_now(users, *args, **kwargs)
+        notification.send_now = send_now
+
+    def tearDown(self):
+        notification.send_now = self._old_send_now
+        notification.send_to_facebook = self._old_send_to_facebook
+
+    def queued_users(self, batch):
+        return [notice[0] for notice in pickle.loads(str(batch.pickled_data).decode("base64"))]
+
+    def make_due(self):
+        NoticeQueueBatch.objects.update(send_at=datetime.datetime.now() - datetime.timedelta(seconds=1))
+
+    def test_retry_keeps_unsent_notices(self):
+        self.failing.add(self.users[1].pk)
+        notification.queue(self.users, "failing")
+        before = datetime.datetime.now()
+        summary = engine.send_all()
+        self.assertEqual(summary["batches"], 0)
+        self.assertEqual([(failed["attempts"], failed["dead_letter"]) for failed in summary["failures"]],
+                         [(1, False)])
+        self.assertEqual(notification.Notice.objects.count(), 1)
+        batch = NoticeQueueBatch.objects.get()
+        self.assertEqual(batch.attempts, 1)
+        self.assertEqual(self.queued_users(batch), [self.users[1].pk, self.users[2].pk])
+        self.failUnless(batch.send_at >= before + datetime.timedelta(seconds=engine.RETRY_DELAY))
+
+    def test_lost_batch_skips_sent_users(self):
+        notification.queue(self.users, "failing")
+        batch = NoticeQueueBatch.objects.get()
+        key = engine._batch_idempotency_key(batch)
+        self.assertEqual(NoticeQueueBatch.objects.get().idempotency_key, key)
+        # the worker got as far as the first user
+        self.failing.add(self.users[1].pk)
+        engine._send_batch(batch.pickled_data, idempotency_key=key)
+        engine._fail_batch({"failures": []}, batch,
+                           engine._lost_batch_failure(batch, "WorkerLost", "worker died"))
+        self.assertEqual(self.queued_users(NoticeQueueBatch.objects.get()), [user.pk for user in self.users])
+        self.failing.clear()
+        self.make_due()
+        summary = engine.send_all()
+        self.assertEqual((summary["sent"], summary["skipped"]), (2, 1))
+        self.assertEqual(notification.Notice.objects.count(), 3)
+
+    def test_retry_backs_off(self):
+        self.failing.add(self.users[0].pk)
+        notification.queue(self.users, "failing")
+        engine.send_all()
+        # not due yet
+        summary = engine.send_all()
+        self.assertEqual(summary["failures"], [])
+        self.assertEqual(NoticeQueueBatch.objects.get().attempts, 1)
+        self.failIf(summary["next_due"] is None)
+
+        self.make_due()
+        before = datetime.datetime.now()
+        engine.send_all()
+        batch = NoticeQueueBatch.objects.get()
+        self.assertEqual(batch.attempts, 2)
+        self.failUnless(batch.send_at >= before + datetime.timedelta(seconds=2 * engine.RETRY_DELAY))
+
+        self.failing.clear()
+        self.make_due()
+        summary = engine.send_all()
+        self.assertEqual((summary["batches"], summary["sent"]), (1, 3))
+        self.assertEqual(NoticeQueueBatch.objects.count(), 0)
+
+    def test_dead_letter(self):
+        self.failing.add(self.users[2].pk)
+        notification.queue(self.users, "failing", idempotency_key="dead")
+        NoticeQueueBatch.objects.update(attempts=engine.MAX_ATTEMPTS - 1)
+        summary = engine.send_all()
+        self.assertEqual(summary["failures"][0]["dead_letter"], True)
+        self.assertEqual(NoticeQueueBatch.objects.count(), 0)
+        failed = FailedNoticeBatch.objects.get()
+        self.assertEqual((failed.label, failed.error_type, failed.attempts, failed.idempotency_key),
+                         ("failing", "Boom", engine.MAX_ATTEMPTS, "dead"))
+        self.failUnless("can't send to" in failed.traceback)
+        self.assertEqual(self.queued_users(failed), [self.users[2].pk])
+
+    def test_interrupts_are_not_caught(self):
+        self.error = KeyboardInterrupt
+        self.failing.add(self.users[0].pk)
+        notification.queue(self.users, "failing")
+        batch = NoticeQueueBatch.objects.get()
+        self.assertRaises(KeyboardInterrupt, engine._send_batch, batch.pickled_data)
+        summary = engine.send_all()
+        self.failIf(summary["error"] is None)
+        # left alone for the next run
+        self.assertEqual(summary["failures"], [])
+        self.assertEqual(NoticeQueueBatch.objects.get().attempts, 0)
+
+    def fail_batch(self, label, error_type):
+        FailedNoticeBatch.objects.create(label=label, error_type=error_type, batch_id=0, attempts=3,
+            error="error", pickled_data=pickle.dumps([(self.users[0].pk, label, {}, True, None)]).encode("base64"))
+
+    def test_replay_filters(self):
+        self.fail_batch("failing", "Boom")
+        self.fail_batch("failing", "SMTPException")
+        self.fail_batch("other", "Boom")
+
+        self.assertEqual(engine.replay_failed_notices(labels=["failing"], dry_run=True), 2)
+        self.assertEqual(FailedNoticeBatch.objects.count(), 3)
+        self.assertEqual(NoticeQueueBatch.objects.count(), 0)
+
+        self.assertEqual(engine.replay_failed_notices(labels=["failing"], error_types=["Boom"]), 1)
+        self.assertEqual(sorted(FailedNoticeBatch.objects.values_list("label", "error_type")),
+                         [(u"failing", u"SMTPException"), (u"other", u"Boom")])
+        self.assertEqual(NoticeQueueBatch.objects.get().attempts, 0)
+
+        self.assertEqual(engine.replay_failed_notices(error_types=["Boom", "SMTPException"], chunk_size=1), 2)
+        self.assertEqual(FailedNoticeBatch.objects.count(), 0)
+        self.assertEqual(NoticeQueueBatch.objects.count(), 3)
+
+
+class SendTransactionTest(TransactionTestCase):
+
+    def setUp(self):
+        self._old_send_now = notification.send_now
+        self._old_send_to_facebook = notification.send_to_facebook
+        notification.send_to_facebook = lambda user, context={}: None
+        notification.notice_types.clear()
+        notification.create_notice_type("failing", "Failing", "failing notice")
+        self.users = [User.objects.create_user("failing%d" % i, "failing%d@example.com" % i, "secret")
+                      for i in range(3)]
+        # fails after the notice of the second user is stored
+        def send_now(users, *args, **kwargs):
+            self._old_send_now(users, *args, **kwargs)
+            if users[0].pk == self.users[1].pk:
+                raise Boom("can't send to %s" % users[0])
+        notification.send_now = send_now
+
+    def tearDown(self):
+        notification.send_now = self._old_send_now
+        notification.send_to_facebook = self._old_send_to_facebook
+
+    def test_failed_notice_is_not_stored(self):
+        notification.queue(self.users, "failing")
+        engine.send_all()
+        self.assertEqual(list(notification.Notice.objects.values_list("user", flat=True)), [self.users[0].pk])
+        batch = NoticeQueueBatch.objects.get()
+        self.assertEqual([notice[0] for notice in pickle.loads(str(batch.pickled_data).decode("base64"))],
+                         [self.users[1].pk, self.users[2].pk])
+
+
+class IdempotencyKeyTest(TestCase):
+
+    def test_sent_by_another_process(self):
+        user = User.objects.create_user("idempotent", "idempotent@example.com", "secret")
+        sent_notices = SentNotices([user], "race")
+        IdempotencyKey.objects.create(user=user, key="race")
+        sent_notices.mark_sent(user)
+        self.failUnless(sent_notices.already_sent(user))
+        # the transaction is still usable
+        self.assertEqual(IdempotencyKey.objects.filter(key="race").count(), 1)
@@ -0,0 +1,122 @@
+"""
+Taking over stale locks, for both lock backends.
+"""
+import os
+import sys
+import time
+import shutil
+import socket
+import datetime
+import tempfile
+import subprocess
+
+from django.test import TestCase
+
+from notification.locks import HeartbeatFileLock, DatabaseLock, AlreadyLocked
+from notification.models import EngineLock
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+class HeartbeatFileLockTest(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.name = os.path.join(self.dir, "engine")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def hold(self, owner, pid, age=0):
+        lock_file = self.name + ".lock"
+        open(lock_file, "w").write("%s\n%s\n%s\n" % (owner, socket.gethostname(), pid))
+        then = time.time() - age
+        os.utime(lock_file, (then, then))
+
+    def owner(self):
+        return open(self.name + ".lock").read().split("\n")[0]
+
+    def test_dead_pid_is_broken(self):
+        self.hold("dead", dead_pid())
+        lock = HeartbeatFileLock(self.name)
+        lock.acquire(0)
+        try:
+            self.assertEqual(self.owner(), lock.owner)
+        finally:
+            lock.release()
+        self.failIf(os.path.exists(self.name + ".lock"))
+
+    def test_old_heartbeat_is_broken(self):
+        self.hold("old", os.getpid(), age=120)
+        lock = HeartbeatFileLock(self.name, stale_after=60)
+        lock.acquire(0)
+        lock.release()
+
+    def test_fresh_lock_is_kept(self):
+        self.hold("alive", os.getpid())
+        lock = HeartbeatFileLock(self.name)
+        self.assertRaises(AlreadyLocked, lock.acquire, 0)
+        self.assertEqual(self.owner(), "alive")
+
+    def test_lost_after_takeover(self):
+        lock = HeartbeatFileLock(self.name, heartbeat=0.05)
+        lock.acquire(0)
+        self.failIf(lock.lost)
+        self.hold("thief", os.getpid())
+        time.sleep(0.5)
+        self.failUnless(lock.lost)
+        lock.release()
+        # the new holder's lock is left alone
+        self.assertEqual(self.owner(), "thief")
+
+
+class DatabaseLockTest(TestCase):
+
+    def hold(self, owner, pid, age=0):
+        heartbeat = datetime.datetime.now() - datetime.timedelta(seconds=age)
+        EngineLock.objects.create(name="engine", owner=owner, host=socket.gethostname(), pid=pid,
+                                  acquired=heartbeat, heartbeat=heartbeat)
+
+    def owner(self):
+        return EngineLock.objects.get(name="engine").owner
+
+    # the heartbeat thread would use a connection of its own, so the tests
+    # beat by hand
+    def lock(self, **kwargs):
+        return DatabaseLock("engine", heartbeat=3600, **kwargs)
+
+    def test_dead_pid_is_broken(self):
+        self.hold("dead", dead_pid())
+        lock = self.lock()
+        lock.acquire(0)
+        try:
+            self.assertEqual(self.owner(), lock.owner)
+        finally:
+            lock.release()
+        self.assertEqual(EngineLock.objects.count(), 0)
+
+    def test_old_heartbeat_is_broken(self):
+        self.hold("old", os.getpid(), age=120)
+        lock = self.lock(stale_after=60)
+        lock.acquire(0)
+        lock.release()
+
+    def test_fresh_lock_is_kept(self):
+        self.hold("alive", os.getpid())
+        self.assertRaises(AlreadyLocked, self.lock().acquire, 0)
+        self.assertEqual(self.owner(), "alive")
+
+    def test_lost_after_takeover(self):
+        lock = self.lock()
+        lock.acquire(0)
+        self.failUnless(lock._beat())
+        EngineLock.objects.filter(name="engine").update(owner="thief")
+        self.failIf(lock._beat())
+        # what the heartbeat thread does when its beat fails
+        lock.lost = True
+        lock.release()
+        self.assertEqual(self.owner(), "thief")
@@ -0,0 +1,197 @@
+"""
+Query budgets for the views and the send paths.
+
+Every operation is run at two data sizes. Views must run the same number
+of queries at both sizes, and no more than their budget. Send paths are
+allowed a fixed budget plus a per-recipient one, since every recipient
+gets its own Notice row, and must grow by exactly that much per recipient.
+"""
+import os
+import base64
+
+from django.conf import settings
+from django.db import connection
+from django.test import TestCase
+from django.core.urlresolvers import reverse
+from django.contrib.auth.models import User, Group
+from django.contrib.contenttypes.models import ContentType
+
+from notification import models as notification
+from notification import engine
+from notification.models import Notice, NoticeType, NoticeQueueBatch
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), "templates")
+
+SMALL, LARGE = 2, 12
+
+# queries a request may spend on the session, the user and the
+# notification context processor before the view itself runs
+REQUEST_OVERHEAD = 4
+
+
+def count_queries(func, *args, **kwargs):
+    old_debug = settings.DEBUG
+    settings.DEBUG = True
+    connection.queries = []
+    try:
+        func(*args, **kwargs)
+        return len(connection.queries)
+    finally:
+        settings.DEBUG = old_debug
+
+
+class QueryBudgetTestCase(TestCase):
+    urls = "notification.tests.urls"
+
+    def setUp(self):
+        self._old_template_dirs = settings.TEMPLATE_DIRS
+        settings.TEMPLATE_DIRS = (TEMPLATE_DIR,) + tuple(settings.TEMPLATE_DIRS)
+        self._old_contexts = getattr(settings, "NOTIFICATION_CONTEXTS", {})
+        settings.NOTIFICATION_CONTEXTS = {"group": "auth.group"}
+        self._old_send_to_facebook = notification.send_to_facebook
+        notification.send_to_facebook = lambda user, context={}: None
+        # the module caches outlive the rows that earlier tests rolled back
+        notification.notice_types.clear()
+        notification._send_environments.clear()
+        notification._activity_context_ids.clear()
+
+        self.reader = User.objects.create_user("reader", "reader@example.com", "secret")
+        self.group = Group.objects.create(name="group")
+        self.notice_types = []
+        self.add_notice_types(2)
+        self.client.login(username="reader", password="secret")
+
+    def tearDown(self):
+        settings.TEMPLATE_DIRS = self._old_template_dirs
+        settings.NOTIFICATION_CONTEXTS = self._old_contexts
+        notification.send_to_facebook = self._old_send_to_facebook
+
+    def add_notice_types(self, count):
+        for i in range(len(self.notice_types), len(self.notice_types) + count):
+            notification.create_notice_type("budget_%d" % i, "Budget %d" % i, "budget notice %d" % i)
+            self.notice_types.append(NoticeType.objects.get(label="budget_%d" % i))
+
+    def add_notices(self, count):
+        group_type = ContentType.objects.get_for_model(Group)
+        for i in range(count):
+            Notice.objects.create(user=self.reader, message="notice %d" % i,
+                                  notice_type=self.notice_types[i % len(self.notice_types)],
+                                  on_site=True, context_content_type=group_type,
+                                  context_object_id=self.group.pk)
+
+    def add_users(self, count):
+        start = User.objects.count()
+        return [User.objects.create_user("user%d" % i, "user%d@example.com" % i, "secret")
+                for i in range(start, start + count)]
+
+    def assertConstant(self, name, func, grow, budget):
+        """
+        Runs ``func`` once to warm up the caches, then at SMALL and LARGE
+        sizes (``grow(n)`` adds n more rows), and checks that the number of
+        queries doesn't change and stays within ``budget``.
+        """
+        func()
+        grow(SMALL)
+        small = count_queries(func)
+        grow(LARGE - SMALL)
+        large = count_queries(func)
+        self.assertEqual(small, large, "%s ran %d queries at size %d and %d at size %d" % (
+            name, small, SMALL, large, LARGE))
+        self.failUnless(large <= budget, "%s ran %d queries, its budget is %d" % (name, large, budget))
+
+    def assertPerRecipient(self, name, func, fixed, per_recipient):
+        """
+        Like assertConstant for operations that take a list of recipients:
+        ``func(users)`` must run exactly ``per_recipient`` more queries for
+        each additional user, so that the count for one recipient and for
+        SMALL and LARGE ones lines up, and no more than ``fixed`` plus
+        ``per_recipient`` for each user.
+        """
+        func(self.add_users(1))
+        single = count_queries(func, self.add_users(1))
+        for size in (SMALL, LARGE):
+            queries = count_queries(func, self.add_users(size))
+            self.assertEqual(queries - single, per_recipient * (size - 1),
+                "%s ran %d queries for 1 recipient and %d for %d, %d per recipient is allowed" % (
+                name, single, queries, size, per_recipient))
+            budget = fixed + per_recipient * size
+            self.failUnless(queries <= budget, "%s ran %d queries for %d recipients, its budget is %d" % (
+                name, queries, size, budget))
+
+    def get(self, url, client=None):
+        response = (client or self.client).get(url)
+        self.failUnless(response.status_code in (200, 302), "%s returned %s" % (url, response.status_code))
+        return response
+
+
+class ViewQueryBudgetTest(QueryBudgetTestCase):
+
+    def feed_client(self):
+        self.client.logout()
+        self.client.defaults["HTTP_AUTHORIZATION"] = "Basic %s" % base64.b64encode("reader:secret")
+        return self.client
+
+    def test_notices(self):
+        url = reverse("notification_notices")
+        self.assertConstant("notices", lambda: self.get(url), self.add_notices, REQUEST_OVERHEAD + 2)
+
+    def test_notice_settings(self):
+        url = reverse("notification_notice_settings")
+        self.assertConstant("notice_settings", lambda: self.get(url), self.add_notice_types, REQUEST_OVERHEAD + 2)
+
+    def test_context_notices(self):
+        url = reverse("notification_context_notices", kwargs={"context": "group", "object_id": self.group.pk})
+        self.assertConstant("context_notices", lambda: self.get(url), self.add_notices, REQUEST_OVERHEAD + 4)
+
+    def test_mark_all_seen(self):
+        url = reverse("notification_mark_all_seen")
+        self.assertConstant("mark_all_seen", lambda: self.get(url), self.add_notices, REQUEST_OVERHEAD + 1)
+
+    def test_json_feed(self):
+        url = reverse("notification_json_feed_for_user")
+        client = self.feed_client()
+        self.assertConstant("json_feed", lambda: self.get(url, client), self.add_notices, REQUEST_OVERHEAD + 1)
+
+    def test_context_json_feed(self):
+        url = reverse("notification_context_json_feed_for_user",
+                      kwargs={"context": "group", "object_id": self.group.pk})
+        client = self.feed_client()
+        self.assertConstant("context_json_feed", lambda: self.get(url, client), self.add_notices,
+                            REQUEST_OVERHEAD + 1)
+
+    def test_atom_feed(self):
+        url = reverse("notification_feed_for_user")
+        client = self.feed_client()
+        self.assertConstant("atom_feed", lambda: self.get(url, client), self.add_notices, REQUEST_OVERHEAD + 4)
+
+    def test_context_atom_feed(self):
+        url = reverse("notification_context_feed_for_user",
+                      kwargs={"context": "group", "object_id": self.group.pk})
+        client = self.feed_client()
+        self.assertConstant("context_atom_feed", lambda: self.get(url, client), self.add_notices,
+                            REQUEST_OVERHEAD + 4)
+        self.assertContains(self.get(url, client), "<title>notice 0</title>")
+
+
+class SendQueryBudgetTest(QueryBudgetTestCase):
+
+    def test_send_now(self):
+        label = self.notice_types[0].label
+        # the settings and language lookups, then one Notice insert per recipient
+        self.assertPerRecipient("send_now", lambda users: notification.send_now(users, label), 2, 1)
+
+    def test_queue(self):
+        label = self.notice_types[0].label
+        self.assertPerRecipient("queue", lambda users: notification.queue(users, label), 1, 0)
+
+    def test_send_all(self):
+        label = self.notice_types[0].label
+        def send_all(users):
+            notification.queue(users, label)
+            engine.send_all()
+        # queueing, reading and deleting the batch, loading its users,
+        # finding the queue empty and looking up the next scheduled batch,
+        # then the settings lookup and the Notice insert of each recipient,
+        # which send_all sends one at a time
+        self.assertPerRecipient("send_all", send_all, 6, 2)
+        self.assertEqual(NoticeQueueBatch.objects.count(), 0)
@@ -0,0 +1,68 @@
+"""
+The in-process notice type registry.
+"""
+from django.conf import settings
+from django.db import connection
+from django.test import TestCase
+from django.core.cache import cache
+
+from notification import models as notification
+from notification.models import NoticeType, NoticeTypeRegistry
+
+
+class CountingCache(object):
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.gets = 0
+
+    def get(self, key, *args):
+        self.gets += 1
+        return self.cache.get(key, *args)
+
+    def __getattr__(self, name):
+        return getattr(self.cache, name)
+
+
+class NoticeTypeRegistryTest(TestCase):
+
+    def setUp(self):
+        self._old_cache = notification.cache
+        notification.cache = CountingCache(cache)
+        self._old_debug = settings.DEBUG
+        settings.DEBUG = True
+        notification.create_notice_type("registered", "Registered", "registered notice")
+        self.registry = NoticeTypeRegistry(check_interval=3600)
+
+    def tearDown(self):
+        notification.cache = self._old_cache
+        settings.DEBUG = self._old_debug
+
+    def test_version_checked_once_per_interval(self):
+        self.registry.get("registered")
+        gets = notification.cache.gets
+        for i in range(10):
+            self.registry.get("registered")
+            self.registry.get_by_id(self.registry.get("registered").pk)
+        self.assertEqual(notification.cache.gets, gets)
+
+    def test_changes_of_other_processes(self):
+        self.registry.get("registered")
+        NoticeType.objects.filter(label="registered").update(display="Changed")
+        cache.set(NoticeTypeRegistry.version_key, "bumped elsewhere")
+        self.assertEqual(self.registry.get("registered").display, "Registered")
+        self.registry.check_interval = 0
+        self.assertEqual(self.registry.get("registered").display, "Changed")
+
+    def test_missing_labels_are_remembered(self):
+        self.registry.get("registered")
+        connection.queries = []
+        self.assertRaises(NoticeType.DoesNotExist, self.registry.get, "unknown")
+        self.assertEqual(len(connection.queries), 1)
+        for i in range(10):
+            self.assertRaises(NoticeType.DoesNotExist, self.registry.get, "unknown")
+        self.assertEqual(len(connection.queries), 1)
+        # clear(), which a save in this process triggers, forgets the miss
+        notification.create_notice_type("unknown", "Unknown", "unknown notice")
+        self.registry.clear()
+        self.assertEqual(self.registry.get("unknown").label, "unknown")
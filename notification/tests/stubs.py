@@ -0,0 +1,138 @@
+"""
+Local SMTP and Graph API servers for the delivery tests and benchmarks.
+
+Both answer every request after ``delay`` seconds, handle each connection
+in its own thread and record what they received::
+
+    smtp = StubSMTPServer(delay=0.1)
+    smtp.start()
+    ...
+    smtp.stop()
+    smtp.messages  # [(sender, recipients, data), ...]
+"""
+import time
+import threading
+import SocketServer
+import BaseHTTPServer
+
+
+class _StubServer(object):
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.server = None
+
+    def start(self):
+        self.server = self.server_class(("127.0.0.1", 0), self.handler_class)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self.port = self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def record(self, items, item):
+        self.lock.acquire()
+        try:
+            items.append(item)
+        finally:
+            self.lock.release()
+
+
+class _ThreadingTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+
+
+class _SMTPHandler(SocketServer.StreamRequestHandler):
+    """
+    Just enough SMTP for smtplib.sendmail.
+    """
+    def reply(self, line):
+        self.wfile.write(line + "\r\n")
+        self.wfile.flush()
+
+    def handle(self):
+        stub = self.server.stub
+        self.reply("220 localhost stub")
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command in ("EHLO", "HELO"):
+                self.reply("250 localhost")
+            elif command == "MAIL":
+                sender, recipients = line[10:].strip(), []
+                self.reply("250 OK")
+            elif command == "RCPT":
+                recipients.append(line[8:].strip())
+                self.reply("250 OK")
+            elif command == "DATA":
+                self.reply("354 go ahead")
+                data = []
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line == ".\r\n":
+                        break
+                    data.append(line)
+                time.sleep(stub.delay)
+                stub.record(stub.messages, (sender, recipients, "".join(data)))
+                self.reply("250 OK")
+            elif command == "QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+class StubSMTPServer(_StubServer):
+    server_class = _ThreadingTCPServer
+    handler_class = _SMTPHandler
+
+    def __init__(self, delay=0):
+        _StubServer.__init__(self, delay)
+        self.messages = []
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    allow_reuse_address = True
+
+
+class _GraphHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        stub = self.server.stub
+        body = self.rfile.read(int(self.headers.getheader("content-length") or 0))
+        time.sleep(stub.delay)
+        stub.record(stub.posts, (self.path, body))
+        response = '{"id": "%d"}' % len(stub.posts)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/javascript")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubGraphServer(_StubServer):
+    """
+    Point ``notification.facebook.GraphAPI.graph_url`` at ``url`` to use it.
+    """
+    server_class = _ThreadingHTTPServer
+    handler_class = _GraphHandler
+
+    def __init__(self, delay=0):
+        _StubServer.__init__(self, delay)
+        self.posts = []
+
+    def start(self):
+        _StubServer.start(self)
+        self.url = "http://127.0.0.1:%d/" % self.port
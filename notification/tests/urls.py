@@ -0,0 +1,10 @@
+from django.conf.urls.defaults import *
+
+urlpatterns = patterns('',
+    (r'^notices/', include('notification.urls')),
+    # the app doesn't route these itself
+    (r'^archive/(?P<noticeid>\d+)/$', 'notification.views.archive', {"next_page": "/"}),
+    (r'^delete/(?P<noticeid>\d+)/$', 'notification.views.delete', {"next_page": "/"}),
+    (r'^archived/delete/(?P<noticeid>\d+)/$', 'notification.views.delete',
+     {"next_page": "/", "archived": True}),
+)
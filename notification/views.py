@@ -3,10 +3,9 @@ from django.shortcuts import render_to_response, get_object_or_404
 from django.http import HttpResponseRedirect, Http404
 from django.template import RequestContext
 from django.contrib.auth.decorators import login_required
-from django.contrib.syndication.views import feed
 from django.utils.translation import ugettext as _
 from notification.models import *
-from notification.decorators import basic_auth_required, simple_basic_auth_callback
+from notification.decorators import basic_auth_required, stateless_basic_auth_callback
 from notification.feeds import NoticeUserFeed, ContextNoticeFeed
 try:
     import json
@@ -14,41 +13,49 @@ except ImportError:
     import django.utils.simplejson as json
     
 from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.contrib.contenttypes.models import ContentType
 from django.http import HttpResponse
 from django.core.paginator import Paginator, InvalidPage, EmptyPage
 
-@basic_auth_required(realm='Notices Feed', callback_func=simple_basic_auth_callback)
+def atom_feed(request, feed_class, slug, param):
+    """
+    Renders one of the ``notification.atomformat`` feeds. The legacy
+    syndication view can't do it, it instantiates feeds that aren't
+    ``django.contrib.syndication.feeds.Feed`` subclasses without arguments.
+    """
+    try:
+        feedgen = feed_class(slug, request).get_feed(param)
+    except LookupError:
+        raise Http404
+    response = HttpResponse(mimetype=feedgen.mime_type)
+    feedgen.write(response, 'utf-8')
+    return response
+
+@basic_auth_required(realm='Notices Feed', callback_func=stateless_basic_auth_callback)
 def feed_for_user(request):
-    url = "feed/%s" % request.user.username
-    return feed(request, url, {
-        "feed": NoticeUserFeed,
-    })
+    return atom_feed(request, NoticeUserFeed, "feed", request.user.username)
     
-@basic_auth_required(realm='Notices Feed', callback_func=simple_basic_auth_callback)
+@basic_auth_required(realm='Notices Feed', callback_func=stateless_basic_auth_callback)
 def json_feed_for_user(request):
     return HttpResponse(json.dumps({'notifications': [unicode(e) for e in Notice.objects.notices_for(request.user, on_site=True)]},
                                     ensure_ascii=False),
                         mimetype="application/json")
 
-@basic_auth_required(realm='Context Notices Feed', callback_func=simple_basic_auth_callback)
+@basic_auth_required(realm='Context Notices Feed', callback_func=stateless_basic_auth_callback)
 def context_feed_for_user(request, context, object_id):
-    url = "%s/%s/feed/%s" % (context, object_id, request.user.username)
-    return feed(request, url, {
-        "feed": ContextNoticeFeed,
-    })
+    return atom_feed(request, ContextNoticeFeed, "feed",
+                     "%s/%s/%s" % (context, object_id, request.user.username))
 
-@basic_auth_required(realm='Context Notices Feed', callback_func=simple_basic_auth_callback)
+@basic_auth_required(realm='Context Notices Feed', callback_func=stateless_basic_auth_callback)
 def context_json_feed_for_user(request, context, object_id):
     if context not in settings.NOTIFICATION_CONTEXTS.keys():
         return HttpResponse(json.dumps({'notifications': []}), mimetype="application/json")
         
     app, model = settings.NOTIFICATION_CONTEXTS[context].split('.')    
-    try:
-        context_object = ActivityContext.objects.get(content_type__app_label=app, content_type__model=model, object_id = object_id)
-        notices = Notice.objects.notices_for(request.user, on_site=True,
-                                         context = context_object.content_object)        
-    except ActivityContext.DoesNotExist:
-        notices = []
+    context_type = ContentType.objects.get_by_natural_key(app, model)
+    notices = Notice.objects.notices_for(request.user, on_site=True,
+                                         context_type=context_type, context_object_id=object_id)
     
     return HttpResponse(json.dumps({'notifications': [unicode(e) for e in notices]}, ensure_ascii=False), mimetype="application/json")
 
@@ -69,20 +76,20 @@ def context_notices(request, context, object_id):
     if context not in settings.NOTIFICATION_CONTEXTS.keys():
         raise Http404    
     app, model = settings.NOTIFICATION_CONTEXTS[context].split('.')
-    context_object = None
+    context_type = ContentType.objects.get_by_natural_key(app, model)
     try:
-        context_object = ActivityContext.objects.get(content_type__app_label=app, content_type__model=model, object_id = object_id)
-        raw_notices = Notice.objects.notices_for(request.user, on_site=True,
-                                         context = context_object.content_object)
-        notices = _paginate_notices(request, raw_notices)
-    except ActivityContext.DoesNotExist:
-        notices = []
+        context_object = context_type.get_object_for_this_type(pk=object_id)
+    except ObjectDoesNotExist:
+        context_object = None
+    raw_notices = Notice.objects.notices_for(request.user, on_site=True,
+                                             context_type=context_type, context_object_id=object_id).select_related("notice_type")
+    notices = _paginate_notices(request, raw_notices)
     
     notice_types = NoticeType.objects.all()    
     return render_to_response("notification/context/%s.html" % context, {
         "notices": notices,
         "notice_types": notice_types, #to filter!  
-        "object": context_object.content_object if hasattr(context_object, "content_object") else None
+        "object": context_object
     }, context_instance=RequestContext(request))
     
 @login_required
@@ -98,7 +105,7 @@ def notices(request):
             A list of :model:`notification.Notice` objects that are not archived
             and to be displayed on the site.
     """
-    raw_notices = Notice.objects.notices_for(request.user, on_site=True)
+    raw_notices = Notice.objects.notices_for(request.user, on_site=True).select_related("notice_type")
     notices = _paginate_notices(request, raw_notices)
     return render_to_response("notification/notices.html", {
         "notices": notices,
@@ -125,13 +132,14 @@ def notice_settings(request):
             value is ``True`` or ``False`` depending on a ``request.POST``
             variable called ``form_label``, whose valid value is ``on``.
     """
-    notice_types = NoticeType.objects.all()
+    notice_types = list(NoticeType.objects.all())
+    user_settings = get_notification_settings([request.user], notice_types)
     settings_table = []
     for notice_type in notice_types:
         settings_row = []
         for medium_id, medium_display in NOTICE_MEDIA:
             form_label = "%s_%s" % (notice_type.label, medium_id)
-            setting = get_notification_setting(request.user, notice_type, medium_id)
+            setting = user_settings[(request.user.id, notice_type.id, medium_id)]
             if request.method == "POST":
                 if request.POST.get(form_label) == "on":
                     if not setting.send:
@@ -163,9 +171,33 @@ def notice_settings(request):
         "notice_settings": notice_settings,
     }, context_instance=RequestContext(request))    
 
+def get_notice(user, id, archived=False):
+    """
+    Returns the Notice with the given id, or the ArchivedNotice if
+    ``archived``. A notice that ``archive_notices`` moved is still found by
+    the id it had as a Notice, among the notices of ``user`` since the id
+    may have been given to a new notice since. Raises ObjectDoesNotExist.
+    """
+    if archived:
+        return ArchivedNotice.objects.get(id=id)
+    try:
+        notice = Notice.objects.get(id=id)
+    except Notice.DoesNotExist:
+        notice = None
+    if notice is None or notice.user_id != user.pk:
+        moved = ArchivedNotice.objects.filter(original_id=id, user=user).order_by("-id")[:1]
+        if moved:
+            return moved[0]
+    if notice is None:
+        raise Notice.DoesNotExist
+    return notice
+
 @login_required
-def single(request, id):
-    notice = get_object_or_404(Notice, id=id)
+def single(request, id, archived=False):
+    try:
+        notice = get_notice(request.user, id, archived)
+    except ObjectDoesNotExist:
+        raise Http404
     if request.user == notice.user:
         return render_to_response("notification/single.html", {
             "notice": notice,
@@ -174,37 +206,37 @@ def single(request, id):
 
 #TODO: ajaxify all this stuff
 @login_required
-def archive(request, noticeid=None, next_page=None):
+def archive(request, noticeid=None, next_page=None, archived=False):
     if noticeid:
         try:
-            notice = Notice.objects.get(id=noticeid)
+            notice = get_notice(request.user, noticeid, archived)
             if request.user == notice.user or request.user.is_superuser:
-                notice.archive()
+                # notices in the ArchivedNotice table already are
+                if not notice.archived:
+                    notice.archive()
             else:   # you can archive other users' notices
                     # only if you are superuser.
                 return HttpResponseRedirect(next_page)
-        except Notice.DoesNotExist:
+        except ObjectDoesNotExist:
             return HttpResponseRedirect(next_page)
     return HttpResponseRedirect(next_page)
 
 @login_required
-def delete(request, noticeid=None, next_page=None):
+def delete(request, noticeid=None, next_page=None, archived=False):
     if noticeid:
         try:
-            notice = Notice.objects.get(id=noticeid)
+            notice = get_notice(request.user, noticeid, archived)
             if request.user == notice.user or request.user.is_superuser:
                 notice.delete()
             else:   # you can delete other users' notices
                     # only if you are superuser.
                 return HttpResponseRedirect(next_page)
-        except Notice.DoesNotExist:
+        except ObjectDoesNotExist:
             return HttpResponseRedirect(next_page)
     return HttpResponseRedirect(next_page)
 
 @login_required
 def mark_all_seen(request):
-    for notice in Notice.objects.notices_for(request.user, unseen=True):
-        notice.unseen = False
-        notice.save()
+    Notice.objects.notices_for(request.user, unseen=True).update(unseen=False)
     return HttpResponseRedirect(reverse("notification_notices"))
     
\ No newline at end of file
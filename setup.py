@@ -8,7 +8,7 @@ setup(
     author='James Tauber',
     author_email='jtauber@jtauber.com',
     url='http://code.google.com/p/django-notification/',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Environment :: Web Environment',